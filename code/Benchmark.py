@@ -0,0 +1,252 @@
+import os
+import glob
+import json
+import time
+import platform
+import tracemalloc
+import numpy as np
+from contextlib import nullcontext
+from functools import partial
+from multiprocessing import Pool, cpu_count
+
+import Null_kernel
+import Run_log
+from Mutual_information import (mutual_information, calculate_shuffled_mi, distance_grid, encode_tokens,
+                                sketch_mutual_information)
+from Token_store import iter_id_chunks, load_ids
+from Tokenizer import tokenizer
+
+# Offline benchmark of the MI and tokenizer stages on synthetic corpora whose
+# I(d) is known. Every run writes data/benchmarks/benchmark.json (sorted keys,
+# one record per stage and setting) and prints how it compares with the
+# previous file, so regressions in speed, memory or numbers show up as diffs.
+
+# Synthetic token streams
+def zipf_iid(N, V, rng, exponent=1.0):
+    # Independent tokens, I(d) = 0
+    p = 1 / np.arange(1, V + 1) ** exponent
+    return rng.choice(V, size=N, p=p / p.sum())
+
+def markov_chain(N, V, rng, stay=0.7):
+    # Each token repeats the previous one with probability stay, otherwise it
+    # is drawn uniformly; the transition matrix after d steps is
+    # stay**d * I + (1 - stay**d) / V
+    repeat = rng.random(N) < stay
+    repeat[0] = False
+    source = np.maximum.accumulate(np.where(repeat, 0, np.arange(N)))
+    return rng.integers(V, size=N)[source]
+
+def hierarchical(N, V, rng, stay=0.8):
+    # Binary tree of depth ceil(log2 N): every child copies its parent with
+    # probability stay, otherwise it is drawn uniformly. Two leaves whose
+    # lowest common ancestor is h levels up are linked by a chain of 2h such
+    # steps, which gives a slow, power-law-like decay of I(d).
+    symbols = rng.integers(V, size=1)
+    for _ in range(int(np.ceil(np.log2(max(N, 2))))):
+        parents = np.repeat(symbols, 2)
+        symbols = np.where(rng.random(len(parents)) < stay, parents, rng.integers(V, size=len(parents)))
+    return symbols[:N]
+
+def symmetric_mi(coupling, V):
+    # MI of a uniform pair linked by coupling * I + (1 - coupling) / V
+    same = coupling + (1 - coupling) / V
+    other = (1 - coupling) / V
+    return same * np.log(V * same) + ((V - 1) * other * np.log(V * other) if other > 0 else 0.0)
+
+def expected_mi(process, N, V, max_d):
+    expected = np.zeros(max_d)
+    for d in range(1, min(max_d, N)):
+        if process == 'markov':
+            expected[d] = symmetric_mi(0.7 ** d, V)
+        elif process == 'hierarchical':
+            i = np.arange(N - d)
+            heights = np.frexp((i ^ (i + d)).astype(np.float64))[1]
+            expected[d] = symmetric_mi(np.mean(0.8 ** (2 * heights)), V)
+    return expected
+
+processes = {'zipf': zipf_iid, 'markov': markov_chain, 'hierarchical': hierarchical}
+
+def miller_madow_bias(ids, d):
+    # Leading finite-sample bias of the plug-in MI estimate at distance d
+    F = len(ids) - d
+    x, y = ids[:F], ids[d:]
+    cells = len(np.unique(x * (int(ids.max()) + 1) + y))
+    return (cells - len(np.unique(x)) - len(np.unique(y)) + 1) / (2 * F)
+
+def check_mi(ids, mi, expected, V):
+    # The bias-corrected estimate must be within 5% of I(d) plus ten times the
+    # leading bias term (V - 1)**2 / 2F
+    distances = np.arange(1, len(mi))
+    F = len(ids) - distances
+    error = np.abs(mi[1:] - [miller_madow_bias(ids, d) for d in distances] - expected[1:])
+    tolerance = 0.05 * expected[1:] + 10 * (V - 1) ** 2 / (2 * F)
+    return {'max_abs_error': float(error.max()), 'max_error_ratio': float((error / tolerance).max()),
+            'passed': bool(np.all(error <= tolerance))}
+
+def check_null(process, mi, shuffled_mis):
+    # i.i.d. corpora are exchangeable, so their MI must look like a shuffle;
+    # the correlated ones must stand out of the null at d = 1
+    mean, std = shuffled_mis[:, 1:].mean(axis=0), shuffled_mis[:, 1:].std(axis=0)
+    z = (mi[1:] - mean) / np.where(std > 0, std, np.inf)
+    passed = bool(np.all(np.abs(z) <= 6)) if process == 'zipf' else bool(z[0] > 5)
+    return {'max_abs_z': float(np.abs(z).max()), 'z_at_1': float(z[0]), 'passed': passed}
+
+# Measurements: the time is the best of repeats untraced runs, the peak
+# memory comes from one extra run under tracemalloc. A pooled stage gets the
+# pool as its pool argument; its extra run uses a fresh pool forked with the
+# run log stages enabled, so that every worker reports its own peak RSS
+# (VmHWM) with its results, and the largest is kept
+def measure(function, args, repeats, pool=None, processes=None):
+    pool_args = {} if pool is None else {'pool': pool}
+    seconds = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        result = function(*args, **pool_args)
+        seconds.append(time.perf_counter() - start)
+    with Run_log.recording() as stage_records, \
+            (Pool(processes) if pool is not None else nullcontext()) as fresh_pool:
+        tracemalloc.start()
+        function(*args, **({} if pool is None else {'pool': fresh_pool}))
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+    record = {'seconds': min(seconds), 'peak_traced_mb': peak / 2**20}
+    if pool is not None:
+        record['peak_rss_workers_mb'] = max((r['peak_rss_mb'] for r in stage_records
+                                             if r['pid'] != os.getpid() and 'peak_rss_mb' in r), default=None)
+    return result, record
+
+def synthetic_text(ids, rng):
+    # Words w<id> with commas, full stops and paragraph breaks in between
+    words = [f"w{i}" for i in ids]
+    marks = rng.choice(['', '', '', '', ',', '.', '.\n\n'], size=len(words))
+    return ' '.join(word + mark for word, mark in zip(words, marks)), words
+
+def benchmark_tokenizer(N, V, rng, repeats):
+    try:
+        import spacy
+    except ImportError:
+        return {'skipped': 'spaCy is not installed'}
+    # A blank pipeline runs the same rule-based tokenizer as the disabled
+    # pipelines of tokenize_text, without downloading any model
+    nlp = spacy.blank('en')
+    text, words = synthetic_text(zipf_iid(N, V, rng), rng)
+    tokens, record = measure(tokenizer, (text, nlp), repeats)
+    record['passed'] = tokens == words
+    return record
+
+def benchmark_backends(sizes, vocabularies, max_d, num_shuffles, repeats, seed=0):
+    # The compiled and NumPy null kernels must give bit-identical rows
+    if Null_kernel.njit is None:
+        return [{'stage': 'null_backends', 'skipped': 'Numba is not installed'}]
+    records = []
+    seeds = [Null_kernel.stream_seed((seed, k)) for k in range(num_shuffles)]
+    distances = np.arange(1, max_d)
+    for process, generate in processes.items():
+        for N in sizes:
+            for V in vocabularies:
+                ids = generate(N, V, np.random.default_rng(seed))
+                numpy_rows, numpy_record = measure(Null_kernel.null_rows, (ids, seeds, distances, 'numpy'), repeats)
+                numba_rows, record = measure(Null_kernel.null_rows, (ids, seeds, distances, 'numba'), repeats)
+                records.append({'stage': 'null_backends', 'process': process, 'N': N, 'V': V, 'max_d': max_d,
+                                'num_shuffles': num_shuffles, **record, 'numpy_seconds': numpy_record['seconds'],
+                                'passed': bool(np.array_equal(numpy_rows, numba_rows))})
+                print(f"null_backends {process} N={N} V={V}: numba {record['seconds']:.3f}s, "
+                      f"numpy {numpy_record['seconds']:.3f}s, identical: {records[-1]['passed']}")
+    return records
+
+def benchmark_sketch(books, max_d, sketch_sizes, depth, repeats):
+    # Accuracy of the count-min estimate against the exact engine on real
+    # books; the estimate must be above the exact MI (up to rounding)
+    records = []
+    grid = distance_grid(max_d)
+    for path in books:
+        ids, vocabulary_size = encode_tokens(load_ids(path))
+        exact = mutual_information(ids, max_d)
+        for sketch_bytes in sketch_sizes:
+            chunks = partial(iter_id_chunks, path, 2**20)
+            (mi, bound), record = measure(sketch_mutual_information, (chunks, grid, sketch_bytes, depth), repeats)
+            error = mi[1:] - exact[1:]
+            records.append({'stage': 'sketch_mi', 'process': os.path.basename(path), 'N': len(ids),
+                            'V': vocabulary_size, 'max_d': max_d, 'sketch_bytes': sketch_bytes, 'depth': depth,
+                            **record, 'max_abs_error': float(np.abs(error).max()),
+                            'max_relative_error': float(np.max(np.abs(error) / exact[1:])),
+                            'max_error_bound': float(bound[1:].max()),
+                            'within_bound': bool(np.all(error <= bound[1:] + 1e-9)),
+                            'passed': bool(np.all(error >= -1e-9))})
+            print(f"sketch_mi {os.path.basename(path)} {sketch_bytes >> 20} MB: max error {np.abs(error).max():.4f}, "
+                  f"bound {bound[1:].max():.4f}")
+    return records
+
+def run_benchmarks(sizes, vocabularies, max_ds, shuffle_counts, repeats, pool, processes, seed=0):
+    records = []
+    for process, generate in processes.items():
+        for N in sizes:
+            for V in vocabularies:
+                ids = generate(N, V, np.random.default_rng(seed))
+                for max_d in max_ds:
+                    setting = {'process': process, 'N': N, 'V': V, 'max_d': max_d}
+                    expected = expected_mi(process, N, V, max_d)
+                    mi, record = measure(mutual_information, (ids, max_d), repeats)
+                    records.append({'stage': 'mutual_information', **setting, **record, **check_mi(ids, mi, expected, V)})
+                    print(f"mutual_information {setting}: {record['seconds']:.3f}s")
+
+                    for num_shuffles in shuffle_counts:
+                        shuffled_mis, record = measure(partial(calculate_shuffled_mi, seed=seed), (ids, max_d, num_shuffles),
+                                                       1, pool, processes)
+                        records.append({'stage': 'calculate_shuffled_mi', **setting, 'num_shuffles': num_shuffles,
+                                        'backend': Null_kernel.backend, **record, **check_null(process, mi, shuffled_mis)})
+                        print(f"calculate_shuffled_mi {setting} x{num_shuffles}: {record['seconds']:.3f}s")
+
+    for N in sizes:
+        for V in vocabularies:
+            record = benchmark_tokenizer(N, V, np.random.default_rng(seed), repeats)
+            records.append({'stage': 'tokenizer', 'process': 'zipf', 'N': N, 'V': V, **record})
+            print(f"tokenizer N={N} V={V}: {record.get('seconds', record.get('skipped'))}")
+    return records
+
+def record_key(record):
+    return tuple(str(record.get(k)) for k in ('stage', 'process', 'N', 'V', 'max_d', 'num_shuffles', 'sketch_bytes'))
+
+def compare(previous, records):
+    # Time ratio against the previous run, and every check whose outcome changed
+    old = {record_key(r): r for r in previous}
+    for record in records:
+        before = old.get(record_key(record))
+        if before is None or 'seconds' not in before or 'seconds' not in record:
+            continue
+        ratio = record['seconds'] / before['seconds'] if before['seconds'] > 0 else float('nan')
+        flag = '  <-- check changed' if before.get('passed') != record.get('passed') else ''
+        print(f"{' '.join(record_key(record)):<60} {ratio:6.2f}x{flag}")
+
+if __name__ == "__main__":
+    output_path = "data/benchmarks/benchmark.json"
+    sizes = [2**14, 2**16, 2**18]  # Corpus sizes in tokens
+    vocabularies = [8, 64]  # Vocabulary sizes
+    max_ds = [30]  # Maximum distances
+    shuffle_counts = [8]  # Numbers of shuffles of the null
+    repeats = 3  # Timed runs of every stage (the fastest is kept)
+    seed = 0
+    books = sorted(glob.glob("data/tokenized/*.tokens"))  # Real corpora of the sketch accuracy check
+    sketch_sizes = [2**24, 2**27]  # Total memory of the count-min sketches
+    sketch_depth = 4
+
+    processes = cpu_count()
+    with Pool(processes) as pool:
+        records = run_benchmarks(sizes, vocabularies, max_ds, shuffle_counts, repeats, pool, processes, seed)
+    records += benchmark_backends(sizes, vocabularies, max_ds[0], shuffle_counts[0], repeats, seed)
+    records += benchmark_sketch(books, max_ds[0], sketch_sizes, sketch_depth, 1)
+
+    failed = [record_key(r) for r in records if r.get('passed') is False]
+    print(f"{len(records) - len(failed)} of {len(records)} benchmarks passed their checks")
+    for key in failed:
+        print("Failed:", ' '.join(key))
+
+    if os.path.exists(output_path):
+        with open(output_path, 'r', encoding='utf-8') as f:
+            compare(json.load(f)['records'], records)
+    os.makedirs(os.path.dirname(output_path), exist_ok=True)
+    with open(output_path, 'w', encoding='utf-8') as f:
+        json.dump({'machine': {'python': platform.python_version(), 'numpy': np.__version__,
+                               'cpus': cpu_count(), 'null_backend': Null_kernel.backend},
+                   'records': records}, f, indent=1, sort_keys=True)
+    print(f"Benchmark written to {output_path}")
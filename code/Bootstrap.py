@@ -0,0 +1,83 @@
+import hashlib
+import numpy as np
+
+# Batched bootstrap of the Theil-Sen decay exponent (slope of log I(d) vs
+# log d). Each batch of resamples of a corpus is a (resample, point) array
+# whose pairwise slopes are taken by broadcasting and whose medians come from
+# one sort, so no fit runs in a Python loop over the resamples. A resample
+# draws the points of a corpus with replacement ('distances'), adds to each
+# MI value the deviation of a random shuffle from the null mean at its
+# distance ('null'), or both. Every corpus draws from its own generator,
+# seeded by its name, and its batches only depend on its own points, so its
+# interval is the same whatever other corpora are bootstrapped with it.
+methods = ('distances', 'null', 'both')
+batch_elements = 2**22  # Pairwise slopes held in memory per batch
+
+def theil_sen_medians(x, y):
+    # Median over the pairs with x_j > x_i of (y_j - y_i) / (x_j - x_i), along
+    # the last axis; NaN points are left out, as in scipy's theilslopes
+    dx = x[..., None, :] - x[..., :, None]
+    dy = y[..., None, :] - y[..., :, None]
+    slopes = np.full(dx.shape, np.nan)
+    np.divide(dy, dx, out=slopes, where=dx > 0)
+    slopes = slopes.reshape(*slopes.shape[:-2], -1)
+    slopes.sort(axis=-1)  # NaN sorts last
+    valid = np.sum(~np.isnan(slopes), axis=-1)
+    low = np.take_along_axis(slopes, np.maximum((valid - 1) // 2, 0)[..., None], axis=-1)[..., 0]
+    high = np.take_along_axis(slopes, (valid // 2)[..., None], axis=-1)[..., 0]
+    return np.where(valid > 0, (low + high) / 2, np.nan)
+
+def corpus_rng(seed, key):
+    digest = hashlib.sha256(str(key).encode('utf-8')).digest()
+    return np.random.default_rng([seed, int.from_bytes(digest[:8], 'little')])
+
+def corpus_slopes(log_d, mi, deviations, resamples, method, rng):
+    # Bootstrap slopes of one corpus; deviations is its (shuffle, point)
+    # matrix, or None when its shuffles were not stored
+    n = len(log_d)
+    batch = max(1, batch_elements // (n * n))
+    slopes = np.empty(resamples)
+    for start in range(0, resamples, batch):
+        b = min(batch, resamples - start)
+        if method in ('distances', 'both'):
+            picks = rng.integers(n, size=(b, n))
+        else:
+            picks = np.broadcast_to(np.arange(n), (b, n))
+        x, y = log_d[picks], mi[picks]
+        if method in ('null', 'both') and deviations is not None and len(deviations):
+            y = y + deviations[rng.integers(len(deviations), size=(b, n)), picks]
+        # Values pushed to MI <= 0 by the noise have no logarithm and drop out
+        with np.errstate(divide='ignore', invalid='ignore'):
+            y = np.where(y > 0, np.log(y), np.nan)
+        slopes[start:start + b] = theil_sen_medians(x, y)
+    return slopes
+
+def bootstrap_slopes(point_sets, resamples=2000, confidence=0.95, method='both', seed=0, keys=None):
+    # point_sets: one (d_values, mi_values, null_deviations) per corpus, where
+    # null_deviations is a (shuffle, point) matrix or None, and keys their
+    # names (the positions by default). Returns the (corpus, 2) lower and upper
+    # bounds of the percentile interval, NaN for corpora with fewer than two points.
+    if method not in methods:
+        raise ValueError(f"Unknown bootstrap method {method!r}, expected one of {methods}")
+    keys = range(len(point_sets)) if keys is None else keys
+    bounds = np.full((len(point_sets), 2), np.nan)
+    alpha = (1 - confidence) / 2
+    for i, ((d_values, mi_values, deviations), key) in enumerate(zip(point_sets, keys)):
+        if len(d_values) < 2:
+            continue
+        slopes = corpus_slopes(np.log(np.asarray(d_values, dtype=np.float64)), np.asarray(mi_values, dtype=np.float64),
+                               deviations, resamples, method, corpus_rng(seed, key))
+        valid = slopes[~np.isnan(slopes)]
+        if len(valid):
+            bounds[i] = np.quantile(valid, [alpha, 1 - alpha])
+    return bounds
+
+def null_deviations(results, points):
+    # Deviation of every stored shuffle from the null mean at the given
+    # positions of the d > 0 arrays, None when the shuffles were not stored
+    if 'shuffled_mis' not in results or results['shuffled_mis'].ndim != 2:
+        return None
+    shuffled = results['shuffled_mis'][:, 1:]
+    # Shuffles skipped by the adaptive test (NaN) leave the value unchanged
+    with np.errstate(invalid='ignore'):
+        return np.nan_to_num(shuffled - np.nanmean(shuffled, axis=0))[:, points]
@@ -0,0 +1,99 @@
+import os
+from functools import partial
+from multiprocessing import Pool, cpu_count
+
+import matplotlib
+matplotlib.use('Agg')
+
+import numpy as np
+import Plots
+import Run_log
+import plot_2
+import test_plots
+from Bootstrap import bootstrap_slopes, null_deviations
+from Results_store import list_corpora, load_results
+
+# Single pass over the MI results: every corpus is loaded once by one pool
+# worker, which runs the three fit variants on it (Theil-Sen on the p-value
+# significant points, Theil-Sen above the distance threshold of plot_2, and
+# the power law with constant of test_plots) and renders their plots with the
+# Agg backend. The fits of all corpora go to one table, with bootstrap
+# intervals of both Theil-Sen slopes computed for all corpora at once. Run
+# alone, Plots, plot_2 and test_plots still render their own variant, each
+# plot once, through their save_theil_sen_data.
+plot_dirs = {'theil_sen': "data/plots", 'theil_sen_2': "data/plots_2", 'power_ct': "data/test_plots"}
+fit_columns = ['File', 'Slope', 'Slope_low', 'Slope_high', 'Intercept',
+               'Slope_2', 'Slope_2_low', 'Slope_2_high', 'Intercept_2', 'C', 'Alpha', 'D']
+
+def plot_path(variant, base_name):
+    return os.path.join(plot_dirs[variant], f"{base_name}.png")
+
+def fit_corpus(base_name, mi_results_dir, percentage):
+    with Run_log.stage('fit_corpus', corpus=base_name):
+        results = load_results(mi_results_dir, base_name, fields=('mi', 'p_values', 'avg_shuffled_mi', 'shuffled_mis'))
+        mi_data = results['mi']
+        pvalues_data = results['p_values']
+        avg_shuffled_mi_data = results['avg_shuffled_mi']
+        distances = results['distances']
+
+        slope, intercept = Plots.plot_mi_d(mi_data, pvalues_data, avg_shuffled_mi_data,
+                                           plot_path('theil_sen', base_name), distances=distances)
+        slope_2, intercept_2 = plot_2.plot_mi_d(mi_data, avg_shuffled_mi_data, plot_path('theil_sen_2', base_name),
+                                                percentage, distances=distances)
+        params = test_plots.plot_mi_d(mi_data, pvalues_data, avg_shuffled_mi_data,
+                                      plot_path('power_ct', base_name), distances=distances)
+    C, alpha, D = np.full(3, np.nan) if params is None else params
+    # Points of both Theil-Sen fits, for the bootstrap
+    point_sets = []
+    for selected in (Plots.significant_points(pvalues_data),
+                     plot_2.threshold_points(mi_data, avg_shuffled_mi_data, percentage)):
+        point_sets.append((distances[1:][selected], mi_data[1:][selected], null_deviations(results, selected)))
+    return [base_name, slope, intercept, slope_2, intercept_2, C, alpha, D], point_sets
+
+def make_output_dirs(output_file):
+    for directory in [*plot_dirs.values(), os.path.dirname(output_file) or '.']:
+        os.makedirs(directory, exist_ok=True)
+
+def write_fits(fits, output_file, resamples=2000, method='both', columns=fit_columns):
+    # fits: the (row, point_sets) of fit_corpus, in the order of the table. A
+    # row holds the columns without the _low/_high ones, which are the 95%
+    # intervals of the k-th slope with bounds, bootstrapped from point_sets[k].
+    # Plots and plot_2 write their tables through here, so every table gives
+    # a corpus the same interval.
+    slopes = [column[:-len('_low')] for column in columns if column.endswith('_low')]
+    names = [row[0] for row, _ in fits]
+    with Run_log.stage('bootstrap', corpora=len(fits), resamples=resamples, method=method):
+        bounds = [bootstrap_slopes([point_sets[k] for _, point_sets in fits], resamples, method=method, keys=names)
+                  for k in range(len(slopes))]
+    row_columns = [column for column in columns if not column.endswith(('_low', '_high'))]
+    with open(output_file, 'w') as f:
+        f.write(','.join(columns) + '\n')
+        for i, (row, _) in enumerate(fits):
+            values = dict(zip(row_columns, row))
+            for k, slope in enumerate(slopes):
+                values[f"{slope}_low"], values[f"{slope}_high"] = bounds[k][i]
+            f.write(','.join(str(values[column]) for column in columns) + '\n')
+    print(f"Fit data saved to {output_file}")
+
+def save_fits(corpora, mi_results_dir, output_file, percentage, resamples=2000, method='both', pool=None):
+    make_output_dirs(output_file)
+    fit = partial(Run_log.call_collected, partial(fit_corpus, mi_results_dir=mi_results_dir, percentage=percentage))
+    # pool.imap keeps the rows in the order of the corpora
+    completed = pool.imap(fit, corpora) if pool is not None else map(fit, corpora)
+    fits = Run_log.gather(Run_log.track(completed, "Fitted corpora", len(corpora)))
+    write_fits(fits, output_file, resamples, method)
+
+if __name__ == "__main__":
+    mi_results_dir = "data/mi_results"
+    output_fits_file = "data/csv/fits.csv"
+    percentage = 0.01  # Distance threshold of plot_2
+    resamples = 2000  # Bootstrap resamples of the Theil-Sen slopes
+    bootstrap_method = 'both'  # Resample the distances, perturb with the shuffle null, or both
+    run_log_path = "data/csv/fits_run_log.json"  # None to disable
+
+    corpora = list_corpora(mi_results_dir)
+
+    with Run_log.run_log(run_log_path, 'Fit_engine', percentage=percentage, resamples=resamples,
+                         bootstrap_method=bootstrap_method), Pool(cpu_count()) as pool:
+        save_fits(corpora, mi_results_dir, output_fits_file, percentage, resamples, bootstrap_method, pool)
+    print("All plots and fit data generated.")
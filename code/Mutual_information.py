@@ -1,140 +1,762 @@
 import os
 import numpy as np
 import pandas as pd
-import random
-from collections import Counter
+import tempfile
+import threading
+import time
+from contextlib import ExitStack, contextmanager
+from functools import partial
 from multiprocessing import Pool, cpu_count
 from scipy.stats import norm
+import Run_log
+import Work_queue
+from Null_cache import canonical_counts, lookup, null_key, store
+from Null_kernel import null_rows, shuffle_order, stream_seed
+from Results_store import export_text, is_dense, save_store
+from Sketch import add, entropy_error_bound, new_sketch, sketch_width, sum_log_estimates
+from Token_store import iter_id_chunks, load_corpus_stats, load_ids
 
-# Dictionary for the pairs of words
-def create_dataframe(words_list, distance):
-    # Find all the pairs at given distance 
-    pairs = [(words_list[i], words_list[i + distance], i) for i in range(len(words_list) - distance)]
-    # Save into a dataframe
-    df = pd.DataFrame(pairs, columns=['Token x', 'Token y', 'Position of Token x'])
-    df['Distance'] = distance
-    return df
-
-def collect_positions(df):
-    df_grouped = df.groupby(['Token x', 'Token y']).agg({'Position of Token x': list}).reset_index()
-    return df_grouped
-
-# Entropies
-def H_X(pairs) -> float:
-    token_counts = Counter(pairs[0])
-    F = len(pairs[0])
-    H = 0
-
-    for token_x, fx in token_counts.items():
-        if fx != 0:
-            H += fx * np.log(fx)
-
-    H /= F
-    H = np.log(F) - H
-
-    return H
-
-def H_Y(pairs) -> float:
-    token_counts = Counter(pairs[1])
-    F = len(pairs[0])
-    H = 0
-
-    for token_y, fy in token_counts.items():
-        if fy != 0:
-            H += fy * np.log(fy)
-
-    H /= F
-    H = np.log(F) - H
-    return H
-
-def H_XY(pairs, pairs_gr) -> float:
-    F = len(pairs[0])
-    H = 0
-    for pair in pairs_gr:
-        fr = len(pair[2])
-        if fr != 0:
-            H += fr * np.log(fr)
-
-    H /= F
-    H = np.log(F) - H
-
-    return H
-
-# Mutual information
-def I(pairs, pairs_gr) -> float: 
-    HX = H_X(pairs)
-    HY = H_Y(pairs)
-    H = H_XY(pairs, pairs_gr)
-    return HX + HY - H
+# Integer-coded engine: the corpus is encoded once and every entropy is
+# computed from NumPy counts, without building pairs or DataFrames
+def encode_tokens(tokens):
+    # Already encoded corpora (integer id arrays) are used as they are
+    if isinstance(tokens, np.ndarray) and tokens.dtype.kind in 'iu':
+        ids = tokens.astype(np.int64, copy=False)
+        vocabulary_size = int(ids.max()) + 1 if len(ids) else 0
+        return ids, vocabulary_size
+    ids, vocabulary = pd.factorize(np.asarray(tokens, dtype=object))
+    return ids.astype(np.int64, copy=False), len(vocabulary)
 
-def mutual_information(tokens, max_d):
+def sum_xlogx(counts) -> float:
+    counts = counts[counts > 0].astype(np.float64)
+    return np.sum(counts * np.log(counts))
+
+def xlogx(c) -> float:
+    return c * np.log(c) if c > 0 else 0.0
+
+def remove_one(counts, token) -> float:
+    # Change of sum(c*log(c)) when one occurrence of token is removed
+    c = counts[token]
+    counts[token] = c - 1
+    return xlogx(c - 1) - xlogx(c)
+
+def run_lengths(sorted_keys):
+    boundaries = np.flatnonzero(sorted_keys[1:] != sorted_keys[:-1]) + 1
+    return np.diff(np.concatenate(([0], boundaries, [len(sorted_keys)])))
+
+# All distances in one sweep: the marginal sums of c*log(c) are updated
+# incrementally as d grows, and the joint counts of every distance are taken
+# from one preallocated key buffer sorted in place
+def mutual_information_sweep(tokens, max_d):
+    ids, vocabulary_size = encode_tokens(tokens)
+    N = len(ids)
     MI = np.zeros(max_d)
-    for i in range(1, max_d):
-        pairs = create_dataframe(tokens, i)
-        pairs_grouped = collect_positions(pairs)
+    if max_d < 2 or N < 2:
+        return MI
+
+    x_counts = np.bincount(ids[:N - 1], minlength=vocabulary_size)
+    y_counts = np.bincount(ids[1:], minlength=vocabulary_size)
+    Sx = sum_xlogx(x_counts)
+    Sy = sum_xlogx(y_counts)
+
+    shifted = ids * vocabulary_size  # token x part of every pair key
+    buffer = np.empty(N - 1, dtype=np.int64)
+    for d in range(1, min(max_d, N)):
+        with Run_log.stage('mi_distance', d=d, tokens=N):
+            F = N - d
+            if d > 1:
+                # x loses its last token and y its first one
+                Sx += remove_one(x_counts, ids[F])
+                Sy += remove_one(y_counts, ids[d - 1])
+
+            keys = buffer[:F]
+            np.add(shifted[:F], ids[d:], out=keys)
+            keys.sort()
+            Sxy = sum_xlogx(run_lengths(keys))
+
+            MI[d] = np.log(F) - (Sx + Sy - Sxy) / F
+    return MI
+
+def mutual_information(tokens, max_d):
+    return mutual_information_sweep(tokens, max_d)
+
+# Distance schedules: the result arrays are aligned with a grid of distances
+# that always starts with d = 0 (MI 0), so that index 0 keeps its meaning
+# and the dense grid np.arange(max_d) gives the arrays of the sweep
+def log_distances(max_d, num):
+    return np.unique(np.logspace(0, np.log10(max(max_d - 1, 1)), num).round().astype(np.int64))
+
+def geometric_distances(max_d, ratio):
+    distances = [1]
+    while max(distances[-1] + 1, int(np.ceil(distances[-1] * ratio))) < max_d:
+        distances.append(max(distances[-1] + 1, int(np.ceil(distances[-1] * ratio))))
+    return np.array(distances, dtype=np.int64)
+
+def is_positive_int(value):
+    return isinstance(value, (int, np.integer)) and not isinstance(value, bool) and value > 0
+
+def check_schedule(schedule):
+    if schedule is None:
+        return
+    if isinstance(schedule, dict):
+        if len(schedule) != 1 or not {'log', 'geometric'} & set(schedule):
+            raise ValueError(f"schedule must be {{'log': num}} or {{'geometric': ratio}}, got {schedule!r}")
+        if 'log' in schedule and not is_positive_int(schedule['log']):
+            raise ValueError(f"schedule log must be a positive integer, got {schedule['log']!r}")
+        if 'geometric' in schedule and not (isinstance(schedule['geometric'], (int, float, np.number))
+                                            and schedule['geometric'] > 1):
+            raise ValueError(f"schedule geometric ratio must be above 1, got {schedule['geometric']!r}")
+        return
+    distances = list(schedule)
+    if not distances or not all(is_positive_int(d) for d in distances):
+        raise ValueError(f"schedule distances must be positive integers, got {schedule!r}")
+    if any(a >= b for a, b in zip(distances, distances[1:])):
+        raise ValueError(f"schedule distances must be increasing without duplicates, got {schedule!r}")
+
+def distance_grid(max_d, schedule=None):
+    # schedule: None for every d < max_d, {'log': num} for num log-spaced
+    # distances below max_d, {'geometric': ratio} for distances growing by
+    # ratio, or an explicit increasing list of distances (max_d is then unused)
+    check_schedule(schedule)
+    if schedule is None:
+        distances = np.arange(1, max_d)
+    elif isinstance(schedule, dict) and 'log' in schedule:
+        distances = log_distances(max_d, schedule['log'])
+    elif isinstance(schedule, dict) and 'geometric' in schedule:
+        distances = geometric_distances(max_d, schedule['geometric'])
+    else:
+        distances = np.asarray(schedule, dtype=np.int64)
+    return np.unique(np.concatenate(([0], distances))).astype(np.int64)
+
+# Sparse grids: between two distances the marginal counts lose the tokens in
+# between, and the joint counts are sorted for each distance, so the cost
+# grows with the number of distances and not with the largest one
+def mutual_information_sparse(tokens, grid):
+    ids, vocabulary_size = encode_tokens(tokens)
+    N = len(ids)
+    MI = np.zeros(len(grid))
+    x_counts = np.bincount(ids, minlength=vocabulary_size)
+    y_counts = x_counts.copy()
+    shifted = ids * vocabulary_size
+    buffer = np.empty(max(N - 1, 0), dtype=np.int64)
+    previous = 0
+    for j, d in enumerate(grid):
+        if d == 0 or d >= N:
+            continue
+        with Run_log.stage('mi_distance', d=int(d), tokens=N):
+            F = N - d
+            # x loses its last tokens and y its first ones
+            x_counts -= np.bincount(ids[F:N - previous], minlength=vocabulary_size)
+            y_counts -= np.bincount(ids[previous:d], minlength=vocabulary_size)
+            previous = d
+
+            keys = buffer[:F]
+            np.add(shifted[:F], ids[d:], out=keys)
+            keys.sort()
+            MI[j] = np.log(F) - (sum_xlogx(x_counts) + sum_xlogx(y_counts) - sum_xlogx(run_lengths(keys))) / F
+    return MI
+
+def mutual_information_grid(tokens, grid):
+    if is_dense(grid):
+        return mutual_information_sweep(tokens, len(grid))
+    return mutual_information_sparse(tokens, grid)
+
+# Sliding-window profile: I(d) in windows of W tokens starting every S tokens.
+# Pair i of distance d is (ids[i], ids[i + d]), and the window starting at a
+# holds the pairs a <= i < a + W - d, so for every distance the marginal and
+# joint counts follow the window, losing the pairs that leave and gaining the
+# ones that enter. The sums of c*log(c) are only updated for the counts that
+# change.
+def xlogx_values(counts):
+    counts = counts.astype(np.float64)
+    return counts * np.log(np.where(counts > 0, counts, 1))
+
+def shift_counts(counts, leaving, entering):
+    changed, index = np.unique(np.concatenate([leaving, entering]), return_inverse=True)
+    before = counts[changed]
+    after = before + np.bincount(index[len(leaving):], minlength=len(changed)) \
+        - np.bincount(index[:len(leaving)], minlength=len(changed))
+    counts[changed] = after
+    return np.sum(xlogx_values(after) - xlogx_values(before))
+
+def window_starts(N, window, stride):
+    return np.arange(0, max(N - window, 0) + 1, stride)
+
+def windowed_mutual_information(tokens, grid, window, stride):
+    # (window, distance) matrix aligned with window_starts and grid
+    ids, vocabulary_size = encode_tokens(tokens)
+    N = len(ids)
+    W = min(window, N)
+    starts = window_starts(N, W, stride)
+    MI = np.zeros((len(starts), len(grid)))
+    for j, d in enumerate(grid):
+        if d == 0 or d >= W:
+            continue
+        with Run_log.stage('window_distance', d=int(d), windows=len(starts)):
+            F = W - d
+            x, y = ids[:N - d], ids[d:]
+            pair_keys, pairs = np.unique(x * vocabulary_size + y, return_inverse=True)
+            # Both marginals share one count array, y tokens offset by the vocabulary size
+            marginals = np.stack([x, y + vocabulary_size], axis=1)
+            for k, a in enumerate(starts):
+                if k == 0 or stride >= F:
+                    # Windows that do not overlap are counted from scratch
+                    marginal_counts = np.bincount(marginals[a:a + F].ravel(), minlength=2 * vocabulary_size)
+                    pair_counts = np.bincount(pairs[a:a + F], minlength=len(pair_keys))
+                    Sx_Sy, Sxy = sum_xlogx(marginal_counts), sum_xlogx(pair_counts)
+                else:
+                    leaving, entering = slice(a - stride, a), slice(a - stride + F, a + F)
+                    Sx_Sy += shift_counts(marginal_counts, marginals[leaving].ravel(), marginals[entering].ravel())
+                    Sxy += shift_counts(pair_counts, pairs[leaving], pairs[entering])
+                MI[k, j] = np.log(F) - (Sx_Sy - Sxy) / F
+    return starts, MI
+
+# Streaming mode: the corpus arrives as chunks of ids, and the unigram counts
+# and the joint counts of every distance are accumulated across chunks. The
+# last max_d - 1 ids of a chunk are carried over so that pairs straddling a
+# boundary are counted once, and memory is bounded by the vocabulary and the
+# pair tables instead of the corpus length.
+def merge_counts(table, new_keys, new_counts):
+    keys, counts = table
+    keys, inverse = np.unique(np.concatenate([keys, new_keys]), return_inverse=True)
+    counts = np.bincount(inverse, weights=np.concatenate([counts, new_counts])).astype(np.int64)
+    return keys, counts
+
+def stream_windows(chunks, D, stream):
+    # Yields every chunk with the last D ids before it prepended, and the
+    # number of those carried ids; stream collects the unigram counts, the
+    # first and last D ids and the length of the stream
+    stream.update(N=0, counts=np.zeros(0, dtype=np.int64), head=np.zeros(0, dtype=np.int64),
+                  carry=np.zeros(0, dtype=np.int64))
+    for chunk in chunks:
+        chunk = np.asarray(chunk, dtype=np.int64)
+        if len(chunk) == 0:
+            continue
+        chunk_counts = np.bincount(chunk)
+        counts = stream['counts']
+        if len(chunk_counts) > len(counts):
+            counts = np.concatenate([counts, np.zeros(len(chunk_counts) - len(counts), dtype=np.int64)])
+        counts[:len(chunk_counts)] += chunk_counts
+        stream['counts'] = counts
+        if len(stream['head']) < D:
+            stream['head'] = np.concatenate([stream['head'], chunk[:D - len(stream['head'])]])
+
+        carry = stream['carry']
+        window = np.concatenate([carry, chunk])
+        yield window, len(carry)
+        stream['carry'] = window[max(len(window) - D, 0):] if D > 0 else carry
+        stream['N'] += len(chunk)
+
+def window_pair_keys(window, carried, grid):
+    # Keys of the pairs of every distance whose token y lies in the chunk
+    for j, d in enumerate(grid):
+        start = max(carried, d)
+        if d == 0 or start >= len(window):
+            continue
+        yield j, (window[start - d:len(window) - d] << 32) + window[start:]
+
+def marginal_sums(stream, grid):
+    # F and Sx + Sy of every distance with pairs, from the unigram counts
+    x_counts = stream['counts'].copy()
+    y_counts = stream['counts'].copy()
+    carry, head = stream['carry'], stream['head']
+    previous = 0
+    for j, d in enumerate(grid):
+        if d == 0 or d >= stream['N']:
+            continue
+        # x loses the last d tokens of the stream and y the first d ones
+        x_counts -= np.bincount(carry[len(carry) - d:len(carry) - previous], minlength=len(x_counts))
+        y_counts -= np.bincount(head[previous:d], minlength=len(y_counts))
+        previous = d
+        yield j, stream['N'] - d, sum_xlogx(x_counts) + sum_xlogx(y_counts)
 
-        pairs_np = np.transpose(pairs.to_numpy())
-        pairs_grouped_np = pairs_grouped.to_numpy()
+def mutual_information_stream(chunks, max_d, grid=None, stream=None):
+    # The MI is aligned with grid (every d < max_d by default); a stream dict
+    # given by the caller receives the unigram counts and the length
+    grid = np.arange(max_d) if grid is None else grid
+    D = int(grid.max()) if len(grid) else 0  # largest distance
+    tables = [(np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)) for _ in grid]
+    stream = {} if stream is None else stream
+    for window, carried in stream_windows(chunks, D, stream):
+        for j, keys in window_pair_keys(window, carried, grid):
+            tables[j] = merge_counts(tables[j], *np.unique(keys, return_counts=True))
 
-        MI[i] = I(pairs_np, pairs_grouped_np)
+    MI = np.zeros(len(grid))
+    for j, F, S in marginal_sums(stream, grid):
+        MI[j] = np.log(F) - (S - sum_xlogx(tables[j][1])) / F
     return MI
 
-def shuffle_tokens(tokens):
-    shuffled = tokens[:]
-    random.shuffle(shuffled)
-    return shuffled
+def streaming_mutual_information(tokens_path, max_d, chunk_size=2**22, grid=None, stream=None):
+    return mutual_information_stream(iter_id_chunks(tokens_path, chunk_size), max_d, grid, stream)
 
-def calculate_shuffled_mi(tokens, max_d, num_shuffles):
-    with Pool(cpu_count()) as pool:
-        shuffled_mis = pool.starmap(mutual_information, [(shuffle_tokens(tokens), max_d) for _ in range(num_shuffles)])
-    return np.array(shuffled_mis)
+# Approximate mode for vocabularies too large for exact pair tables: the
+# marginals stay exact, and the joint term of every distance comes from a
+# count-min sketch (see Sketch.py) whose memory is fixed up front. The stream
+# is read twice, once to fill the sketches and once to query them, and a
+# bound of the expected overestimate of every MI value is returned with it.
+# The shuffles of the null are estimated with sketches of the same width and
+# depth (sketch_shuffled_mi_task), since against the exact null the
+# overestimate alone would make distances look significant. The memory is
+# that of the sketches of one process: every pool worker holds its own set
+# while it estimates a shuffle (check_sketch_memory).
+def sketch_mutual_information(chunk_source, grid, sketch_bytes=2**28, depth=4, width=None, stream=None):
+    # chunk_source() returns a new iterator over the id chunks of the corpus;
+    # width, when given, replaces the one that fits the sketches in sketch_bytes
+    D = int(grid.max()) if len(grid) else 0
+    width = sketch_width(sketch_bytes, depth, np.count_nonzero(grid)) if width is None else width
+    sketches = {j: new_sketch(depth, width) for j, d in enumerate(grid) if d > 0}
+    stream = {} if stream is None else stream
+    with Run_log.stage('sketch_fill', distances=len(sketches), width=width, depth=depth):
+        for window, carried in stream_windows(chunk_source(), D, stream):
+            for j, keys in window_pair_keys(window, carried, grid):
+                add(sketches[j], keys)
+    S_joint = np.zeros(len(grid))
+    with Run_log.stage('sketch_query', distances=len(sketches)):
+        for window, carried in stream_windows(chunk_source(), D, {}):
+            for j, keys in window_pair_keys(window, carried, grid):
+                S_joint[j] += sum_log_estimates(sketches[j], keys)
+
+    MI = np.zeros(len(grid))
+    error_bound = np.zeros(len(grid))
+    for j, F, S in marginal_sums(stream, grid):
+        MI[j] = np.log(F) - (S - S_joint[j]) / F
+        error_bound[j] = entropy_error_bound(sketches[j], F)
+    return MI, error_bound
+
+# Shuffle null: the shuffled MI only depends on the unigram counts, so the
+# corpus is reduced to its canonical multiset (ids ranked by decreasing count,
+# in sorted order) and written once to a memory-mapped file (in /dev/shm when
+# available). Every worker receives only a seed, shuffles its own copy and
+# returns the MI at the requested distances.
+canonical_block = 2**22  # Tokens of the canonical multiset written at a time
+
+@contextmanager
+def shared_corpus(tokens=None, counts=None):
+    # From the tokens, or from their unigram counts when the corpus was streamed
+    if counts is None:
+        ids, vocabulary_size = encode_tokens(tokens)
+        counts = np.bincount(ids, minlength=vocabulary_size)
+    counts = canonical_counts(counts)
+    dtype = np.dtype(np.int32 if len(counts) < 2**31 else np.int64)
+    length = int(counts.sum())
+    fd, path = tempfile.mkstemp(suffix='.ids', dir='/dev/shm' if os.path.isdir('/dev/shm') else None)
+    try:
+        # Written in blocks of about canonical_block tokens, so that the
+        # multiset is never held in memory
+        with os.fdopen(fd, 'wb') as f:
+            bounds = np.searchsorted(np.cumsum(counts), np.arange(canonical_block, length, canonical_block))
+            for block in np.split(np.arange(len(counts), dtype=dtype), bounds):
+                np.repeat(block, counts[block]).tofile(f)
+        yield (path, length, dtype.str), counts
+    finally:
+        os.remove(path)
+
+def attach_ids(path, length, dtype):
+    return np.memmap(path, dtype=dtype, mode='r', shape=(length,))
+
+def shuffled_mi_task(task):
+    # The shuffle and the counts of every distance run in the fused null
+    # kernel (compiled when Numba is installed)
+    corpus, distances, seed = task
+    with Run_log.stage('shuffle', shuffle=seed[1], distances=len(distances), tokens=corpus[1]):
+        return null_rows(attach_ids(*corpus), [stream_seed(seed)], distances)[0]
+
+def array_chunks(ids, chunk_size):
+    for start in range(0, len(ids), chunk_size):
+        yield ids[start:start + chunk_size]
+
+def sketch_shuffled_mi_task(task):
+    # The same shuffle as the null kernel, with its MI estimated like the
+    # observed one; a worker holds one set of sketches and the shuffled corpus
+    corpus, distances, seed, (width, depth) = task
+    with Run_log.stage('sketch_shuffle', shuffle=seed[1], distances=len(distances), tokens=corpus[1]):
+        ids = attach_ids(*corpus)
+        shuffled = np.asarray(ids, dtype=np.int64)[shuffle_order(stream_seed(seed), len(ids))]
+        grid = np.concatenate(([0], distances))
+        mi, _ = sketch_mutual_information(partial(array_chunks, shuffled, 2**22), grid, depth=depth, width=width)
+        return mi[1:]
+
+def check_sketch_memory(sketch, tables, num_tokens, processes):
+    # Peak of the sketch null: every worker holds its sketches, the shuffled
+    # corpus and the keys of the shuffle (about 48 bytes per token)
+    width, depth = sketch
+    needed = processes * (4 * width * depth * tables + 48 * num_tokens)
+    try:
+        available = os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+    except (ValueError, OSError, AttributeError):
+        return  # Unknown on this platform
+    if needed > available:
+        raise ValueError(f"The sketch null needs about {needed >> 20} MB ({processes} workers), "
+                         f"{available >> 20} MB are available; lower sketch['bytes'] or use a smaller pool")
+
+def run_tasks(function, tasks, pool=None):
+    # Results in task order, with the progress reported as they arrive
+    if pool is None:
+        with Pool(cpu_count()) as own_pool:
+            return run_tasks(function, tasks, own_pool)
+    results = pool.imap(partial(Run_log.call_collected, function), tasks)
+    return Run_log.gather(Run_log.track(results, "Shuffles", len(tasks)))
+
+def shuffled_mi_rows(corpus, counts, seed, shuffles, grid, columns, pool=None, cache_dir=None, cache_bytes=2**30,
+                     cluster=None, sketch=None):
+    # MI of the shuffles k (seeded with (seed, k)) at the distances grid[columns],
+    # as a (len(shuffles), len(grid)) matrix that is NaN at the other distances.
+    # Values found in the null cache are reused and only the missing ones computed,
+    # on the pool or, given a Work_queue dispatcher as cluster, by remote workers.
+    # sketch: None for the exact MI, or the (width, depth) of the sketch estimate.
+    distances = grid[columns]
+    key = null_key(counts, seed, None if sketch is None else {'sketch_width': sketch[0], 'depth': sketch[1]})
+    values = np.full((len(shuffles), len(distances)), np.nan)
+    if cache_dir is not None:
+        values = lookup(cache_dir, key, shuffles, distances)
+    missing = [np.isnan(row) for row in values]
+    tasks = [(corpus, distances[m], (seed, int(k))) + (() if sketch is None else (sketch,))
+             for k, m in zip(shuffles, missing) if m.any()]
+    if cluster is not None:
+        computed = iter(cluster.run(corpus, counts, tasks))
+    else:
+        computed = iter(run_tasks(shuffled_mi_task if sketch is None else sketch_shuffled_mi_task, tasks, pool))
+    for row, m in zip(values, missing):
+        if m.any():
+            row[m] = next(computed)
+    if cache_dir is not None and tasks:
+        store(cache_dir, key, shuffles, distances, values, cache_bytes)
+    num_missing = sum(m.sum() for m in missing)
+    print(f"Shuffle null: {num_missing} values computed, {values.size - num_missing} from cache")
+
+    rows = np.full((len(shuffles), len(grid)), np.nan)
+    rows[:, 0] = 0
+    rows[:, columns] = values
+    return rows
+
+def calculate_shuffled_mi(tokens, max_d, num_shuffles, pool=None, seed=None, cache_dir=None, cache_bytes=2**30,
+                          schedule=None, cluster=None, counts=None, sketch=None):
+    # counts: the unigram counts of a streamed corpus, in place of its tokens
+    seed = np.random.SeedSequence(seed).entropy
+    grid = distance_grid(max_d, schedule)
+    with shared_corpus(tokens, counts) as (corpus, counts):
+        return shuffled_mi_rows(corpus, counts, seed, np.arange(num_shuffles), grid, np.arange(1, len(grid)),
+                                pool, cache_dir, cache_bytes, cluster, sketch)
 
 def calculate_p_values(observed_mi, shuffled_mis):
     p_values = np.zeros_like(observed_mi)
     for d in range(1, len(observed_mi)):
         shuffled_mi_d = shuffled_mis[:, d]
-        mean_shuffled = np.mean(shuffled_mi_d)
-        std_shuffled = np.std(shuffled_mi_d)
+        mean_shuffled = np.nanmean(shuffled_mi_d)
+        std_shuffled = np.nanstd(shuffled_mi_d)
         z_score = (observed_mi[d] - mean_shuffled) / std_shuffled
         p_values[d] = 1 - norm.cdf(z_score)
     return p_values
 
-def calculate_mi_and_p_values(file_path, max_d, num_shuffles):
+# Adaptive sequential testing: shuffles run in batches, and a distance stops
+# receiving shuffles once the confidence interval of its z-score no longer
+# contains the critical value of alpha at the given error rate. The standard
+# error of the z-score is asymptotic, so no distance stops before
+# min_shuffles; a null without spread (every shuffle gives the same MI) has
+# no z-score to refine and stops there too.
+def decision_is_stable(observed_mi, shuffled_mis, alpha, error_rate, min_shuffles=20):
+    n = np.sum(~np.isnan(shuffled_mis), axis=0)
+    std = np.nanstd(shuffled_mis, axis=0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        z_score = (observed_mi - np.nanmean(shuffled_mis, axis=0)) / std
+        # Standard error of a z-score estimated from n samples
+        z_error = np.sqrt(1 / n + z_score ** 2 / (2 * n))
+        distance_to_critical = np.abs(z_score - norm.isf(alpha))
+        stable = distance_to_critical > norm.isf(error_rate / 2) * z_error
+    return (n >= min_shuffles) & (stable | (std == 0))
+
+def adaptive_shuffled_mi(tokens, observed_mi, pool=None, seed=None, alpha=0.05, error_rate=0.01,
+                         batch_size=8, max_shuffles=400, min_shuffles=20, cache_dir=None, cache_bytes=2**30, grid=None,
+                         cluster=None, counts=None, sketch=None):
+    # observed_mi is aligned with grid (every d < len(observed_mi) by default)
+    grid = np.arange(len(observed_mi)) if grid is None else grid
+    seed = np.random.SeedSequence(seed).entropy
+    shuffled_mis = np.empty((0, len(grid)))
+    active = np.arange(1, len(grid))
+    with shared_corpus(tokens, counts) as (corpus, counts):
+        while len(active) > 0 and len(shuffled_mis) < max_shuffles:
+            shuffles = np.arange(len(shuffled_mis), min(len(shuffled_mis) + batch_size, max_shuffles))
+            batch = shuffled_mi_rows(corpus, counts, seed, shuffles, grid, active, pool, cache_dir, cache_bytes, cluster,
+                                     sketch)
+            shuffled_mis = np.vstack([shuffled_mis, batch])
+            stable = decision_is_stable(observed_mi[active], shuffled_mis[:, active], alpha, error_rate, min_shuffles)
+            active = active[~stable]
+    shuffles_used = np.sum(~np.isnan(shuffled_mis), axis=0)
+    shuffles_used[0] = 0
+    return shuffled_mis, shuffles_used
+
+def calculate_mi_and_p_values(file_path, max_d, num_shuffles, pool=None, seed=None, adaptive=None, chunk_size=None,
+                              cache_dir=None, cache_bytes=2**30, schedule=None, window=None, sketch=None,
+                              cluster=None):
     print(f"Processing {file_path}")
-    with open(file_path, 'r', encoding='utf-8') as f:
-        tokens = f.read().split()
-    observed_mi = mutual_information(tokens, max_d)
-    shuffled_mis = calculate_shuffled_mi(tokens, max_d, num_shuffles)
-    p_values = calculate_p_values(observed_mi, shuffled_mis)
-    avg_shuffled_mi = np.mean(shuffled_mis, axis=0)
-    return os.path.basename(file_path), observed_mi, p_values, avg_shuffled_mi
-
-def save_results(result, output_dir):
-    filename, mi, p_values, avg_shuffled_mi = result
-    os.makedirs(output_dir, exist_ok=True)
-    mi_save_path = os.path.join(output_dir, f"{filename}.mi")
-    pv_save_path = os.path.join(output_dir, f"{filename}.pvalues")
-    avg_save_path = os.path.join(output_dir, f"{filename}.avg_shuffled_mi")
-    np.savetxt(mi_save_path, mi)
-    np.savetxt(pv_save_path, p_values)
-    np.savetxt(avg_save_path, avg_shuffled_mi)
-    print(f"Saved mutual information, p-values, and average shuffled MI for {filename}")
+    check_window(window)
+    if sketch is not None and cluster is not None:
+        raise ValueError("The sketch null runs on the local pool; set cluster to None")
+    seed = np.random.SeedSequence(seed).entropy
+    grid = distance_grid(max_d, schedule)
+    start = time.perf_counter()
+    error_bound = None
+    counts = None
+    null_sketch = None
+    if sketch is not None:
+        # Checked before any sketch is allocated
+        null_sketch = (sketch_width(sketch['bytes'], sketch['depth'], np.count_nonzero(grid)), sketch['depth'])
+        check_sketch_memory(null_sketch, np.count_nonzero(grid), load_corpus_stats(file_path)['tokens'],
+                            cpu_count() if pool is None else pool._processes)
+    with Run_log.stage('observed_mi', file=file_path, chunk_size=chunk_size, sketch=sketch):
+        if sketch is not None:
+            # sketch: {'bytes': memory of the sketches of one process, 'depth': rows per sketch}
+            chunks = partial(iter_id_chunks, file_path, chunk_size or 2**22)
+            stream = {}
+            observed_mi, error_bound = sketch_mutual_information(chunks, grid, sketch['bytes'], sketch['depth'],
+                                                                 stream=stream)
+            ids, counts, num_tokens = None, stream['counts'], stream['N']
+        elif chunk_size is None:
+            ids, _ = encode_tokens(load_ids(file_path))
+            observed_mi = mutual_information_grid(ids, grid)
+        else:
+            # The null only needs the unigram counts, collected while streaming
+            stream = {}
+            observed_mi = streaming_mutual_information(file_path, max_d, chunk_size, grid, stream)
+            ids, counts, num_tokens = None, stream['counts'], stream['N']
+        if ids is not None:
+            num_tokens = len(ids)
+        elif window is not None:
+            ids = load_ids(file_path)  # The window profile needs the whole corpus
+        windows = windowed_profile(ids, grid, window)
+    observed_time = time.perf_counter() - start
+    with Run_log.stage('shuffled_mi', file=file_path, adaptive=adaptive is not None):
+        if adaptive is None:
+            shuffled_mis = calculate_shuffled_mi(ids, max_d, num_shuffles, pool=pool, seed=seed,
+                                                 cache_dir=cache_dir, cache_bytes=cache_bytes, schedule=schedule,
+                                                 cluster=cluster, counts=counts, sketch=null_sketch)
+            shuffles_used = None
+        else:
+            shuffled_mis, shuffles_used = adaptive_shuffled_mi(ids, observed_mi, pool=pool, seed=seed,
+                                                               cache_dir=cache_dir, cache_bytes=cache_bytes,
+                                                               grid=grid, cluster=cluster, counts=counts, sketch=null_sketch,
+                                                               **adaptive)
+            print(f"Shuffles used per distance: {shuffles_used[1:].tolist()}")
+    shuffle_time = time.perf_counter() - start - observed_time
+    params = {'max_d': max_d, 'num_shuffles': num_shuffles, 'seed': seed, 'adaptive': adaptive,
+              'chunk_size': chunk_size, 'schedule': schedule, 'window': window, 'sketch': sketch,
+              'num_tokens': num_tokens}
+    timings = {'observed_mi': observed_time, 'shuffled_mi': shuffle_time}
+    result = mi_result(file_path, observed_mi, shuffled_mis, shuffles_used, params, timings, grid, windows)
+    result['mi_error_bound'] = error_bound
+    return result
+
+def check_window(window):
+    # window: None, or {'size': W, 'stride': S} with W, S > 0 for the
+    # sliding-window profile (a W above the corpus length covers the whole corpus)
+    if window is None:
+        return
+    if set(window) != {'size', 'stride'}:
+        raise ValueError(f"window must be {{'size': W, 'stride': S}}, got {window!r}")
+    for name in ('size', 'stride'):
+        if not is_positive_int(window[name]):
+            raise ValueError(f"window {name} must be a positive integer, got {window[name]!r}")
+
+def windowed_profile(ids, grid, window):
+    if window is None:
+        return None
+    return windowed_mutual_information(ids, grid, window['size'], window['stride'])
+
+def mi_result(file_path, observed_mi, shuffled_mis, shuffles_used, params, timings, distances=None, windows=None):
+    window_starts, window_mi = (None, None) if windows is None else windows
+    return {
+        'filename': os.path.basename(file_path),
+        'distances': np.arange(len(observed_mi)) if distances is None else distances,
+        'window_starts': window_starts,
+        'window_mi': window_mi,
+        'mi': observed_mi,
+        'p_values': calculate_p_values(observed_mi, shuffled_mis),
+        'avg_shuffled_mi': np.nanmean(shuffled_mis, axis=0),
+        'shuffled_mis': shuffled_mis,
+        'shuffles_used': shuffles_used,
+        'mi_error_bound': None,
+        'params': params,
+        'timings': timings,
+    }
+
+def save_results(result, output_dir, text_export=False):
+    filename = result['filename']
+    arrays = {name: result[name] for name in ('distances', 'mi', 'p_values', 'avg_shuffled_mi', 'shuffled_mis',
+                                              'shuffles_used', 'window_starts', 'window_mi', 'mi_error_bound')}
+    save_store(output_dir, filename, arrays, result['params'], result['timings'])
+    if text_export:
+        export_text(output_dir, filename)
+    print(f"Saved mutual information, p-values, and shuffled MI for {filename}")
+
+# Cross-corpus scheduler: the observed MI and every shuffle of every file are
+# independent tasks on one pool, ordered largest file first so that the long
+# tasks start early and the small ones fill the cores at the end. A file's
+# results are saved as soon as its last task completes.
+def corpus_sizes(files):
+    # Token counts from the statistics manifests written by the tokenizer
+    return {f: load_corpus_stats(f)['tokens'] for f in files}
+
+def observed_mi_task(task):
+    file_path, grid, window = task
+    with Run_log.stage('observed_mi', file=file_path):
+        ids = load_ids(file_path)
+        return mutual_information_grid(ids, grid), windowed_profile(ids, grid, window)
+
+def scheduled_task(task):
+    index, k, payload = task
+    start = time.perf_counter()
+    result, task_records = Run_log.call_collected(observed_mi_task if k is None else shuffled_mi_task, payload)
+    return index, k, result, time.perf_counter() - start, task_records
+
+def schedule_file(index, file_path, grid, num_shuffles, seed, cache_dir=None, window=None):
+    # Shares the corpus and returns its state and its pool tasks: the observed
+    # MI and every shuffle with values missing from the null cache
+    distances = grid[1:]
+    shuffles = np.arange(num_shuffles)
+    cleanup = ExitStack()
+    ids = load_ids(file_path)
+    corpus, counts = cleanup.enter_context(shared_corpus(ids))
+    key = null_key(counts, seed)
+    values = np.full((num_shuffles, len(distances)), np.nan)
+    if cache_dir is not None:
+        values = lookup(cache_dir, key, shuffles, distances)
+    missing = np.isnan(values)
+    file_tasks = [(index, None, (file_path, grid, window))]
+    file_tasks += [(index, int(k), (corpus, distances[m], (seed, int(k))))
+                   for k, m in zip(shuffles, missing) if m.any()]
+    state = {'file_path': file_path, 'tokens': len(ids), 'cleanup': cleanup, 'key': key, 'values': values,
+             'missing': missing, 'tasks': len(file_tasks), 'pending': len(file_tasks),
+             'start': time.perf_counter(), 'timings': {'shuffled_mi': 0.0}}
+    return state, file_tasks
+
+def record_task(state, k, result, elapsed):
+    # Stores the result of a task of the file; True once its last task is done
+    if k is None:
+        state['observed_mi'], state['windows'] = result
+        state['timings']['observed_mi'] = elapsed
+    else:
+        state['values'][k, state['missing'][k]] = result
+        state['timings']['shuffled_mi'] += elapsed
+    state['pending'] -= 1
+    return state['pending'] == 0
+
+def finish_file(state, grid, max_d, num_shuffles, seed, output_dir, cache_dir=None, cache_bytes=2**30,
+                text_export=False, schedule=None, window=None):
+    # Releases the shared corpus, stores the new null values and saves the results
+    state['cleanup'].close()
+    Run_log.record('file', file=state['file_path'], tokens=state['tokens'], tasks=state['tasks'],
+                   wall=time.perf_counter() - state['start'], **state['timings'])
+    if cache_dir is not None and state['missing'].any():
+        store(cache_dir, state['key'], np.arange(num_shuffles), grid[1:], state['values'], cache_bytes)
+    shuffled_mis = np.full((num_shuffles, len(grid)), np.nan)
+    shuffled_mis[:, 0] = 0
+    shuffled_mis[:, 1:] = state['values']
+    params = {'max_d': max_d, 'num_shuffles': num_shuffles, 'seed': seed, 'adaptive': None,
+              'chunk_size': None, 'schedule': schedule, 'window': window, 'num_tokens': state['tokens']}
+    save_results(mi_result(state['file_path'], state['observed_mi'], shuffled_mis, None, params,
+                           state['timings'], grid, state['windows']), output_dir, text_export)
+
+def calculate_all_mi_and_p_values(files, max_d, num_shuffles, pool, output_dir, seed=None, cache_dir=None,
+                                  cache_bytes=2**30, text_export=False, schedule=None, window=None):
+    check_window(window)
+    seed = np.random.SeedSequence(seed).entropy
+    sizes = corpus_sizes(files)
+    files = sorted(files, key=sizes.get, reverse=True)
+    grid = distance_grid(max_d, schedule)
+    states = []
+
+    stopped = []
+    lock = threading.Lock()
+
+    # Runs in the pool's task feeder thread, so the shared corpora are set up
+    # while the workers already compute the first tasks
+    def tasks():
+        for index, file_path in enumerate(files):
+            with lock:
+                if stopped:
+                    return
+                print(f"Scheduling {file_path} ({sizes[file_path]} tokens)")
+                state, file_tasks = schedule_file(index, file_path, grid, num_shuffles, seed, cache_dir, window)
+                states.append(state)
+            yield from file_tasks
+
+    completed = pool.imap_unordered(scheduled_task, tasks())
+    try:
+        for index, k, result, elapsed, task_records in Run_log.track(completed, "Tasks",
+                                                                     lambda: sum(s['tasks'] for s in states)):
+            Run_log.records.extend(task_records)
+            if record_task(states[index], k, result, elapsed):
+                finish_file(states[index], grid, max_d, num_shuffles, seed, output_dir, cache_dir, cache_bytes,
+                            text_export, schedule, window)
+    finally:
+        # After an error or an interrupt, no file is scheduled any more and the
+        # shared corpora of the unfinished ones are removed from /dev/shm
+        with lock:
+            stopped.append(True)
+            for state in states:
+                state['cleanup'].close()
 
 if __name__ == "__main__":
     tokenized_dir = "data/tokenized"
     output_dir = "data/mi_results"
     max_d = 30  # Define maximum distance
+    # Distances computed below max_d: None for all of them, {'log': num} for num
+    # log-spaced ones, {'geometric': ratio} or an explicit list of distances
+    schedule = None
+    # Set to {'size': W, 'stride': S} to also store I(d) in windows of W tokens every S tokens
+    window = None
     num_shuffles = 40  # Define the number of shuffles for p-value calculation
+    seed = 0  # Define the base seed of the shuffles
+    # Set to a dict of parameters (alpha, error_rate, batch_size, max_shuffles, min_shuffles) to run
+    # the shuffles in batches until the decision of every distance is stable
+    adaptive = None
+    # Set to a number of tokens to compute the observed MI from streamed chunks
+    chunk_size = None
+    # Set to {'bytes': memory, 'depth': rows} to estimate the joint entropies with
+    # count-min sketches of fixed memory (approximate, for huge vocabularies); the
+    # memory is per process, and the null holds one set in every pool worker
+    sketch = None
+    # Set to a (host, port) to serve the shuffles to Work_queue workers on other
+    # machines (python Work_queue.py host:port) instead of the local pool; the
+    # coordinator and the workers share the secret in MI_CLUSTER_AUTHKEY
+    cluster_address = None
+    text_export = False  # Also write the old .mi/.pvalues/.avg_shuffled_mi text files
+    null_cache_dir = "data/null_cache"  # Shuffle-null values reused across runs (None to disable)
+    null_cache_bytes = 2 * 2**30  # Size cap of the null cache
+    run_log_path = os.path.join(output_dir, "run_log.json")  # Timings and memory of the run (None to disable)
+
+    if text_export and not is_dense(distance_grid(max_d, schedule)):
+        raise ValueError("text_export needs every distance below max_d; set schedule to None")
 
     print(f"Maximum distance (max_d): {max_d}")
+    print(f"Distances: {distance_grid(max_d, schedule)[1:].tolist()}")
     print(f"Number of shuffles: {num_shuffles}")
 
     # List all tokenized files
     tokenized_files = [os.path.join(tokenized_dir, f) for f in os.listdir(tokenized_dir) if f.endswith('.tokens')]
 
     print("Starting mutual information and p-value calculation...")
-    for file in tokenized_files:
-        result = calculate_mi_and_p_values(file, max_d, num_shuffles)
-        save_results(result, output_dir)
+    # One pool for all the files, forked after the run log is opened so that
+    # the workers record their stages too
+    with Run_log.run_log(run_log_path, 'Mutual_information', max_d=max_d, schedule=schedule, num_shuffles=num_shuffles,
+                         seed=seed, adaptive=adaptive, chunk_size=chunk_size, window=window, sketch=sketch,
+                         cluster_address=cluster_address, files=len(tokenized_files)), \
+            Pool(cpu_count()) as pool, ExitStack() as stack:
+        cluster = None
+        if cluster_address is not None:
+            cluster = stack.enter_context(Work_queue.coordinator(cluster_address, Work_queue.cluster_authkey()))
+        if adaptive is None and chunk_size is None and sketch is None and cluster is None:
+            calculate_all_mi_and_p_values(tokenized_files, max_d, num_shuffles, pool, output_dir, seed=seed,
+                                          cache_dir=null_cache_dir, cache_bytes=null_cache_bytes,
+                                          text_export=text_export, schedule=schedule, window=window)
+        else:
+            # The adaptive, streaming, sketch and cluster modes process the files one at a time
+            for file in tokenized_files:
+                result = calculate_mi_and_p_values(file, max_d, num_shuffles, pool=pool, seed=seed,
+                                                   adaptive=adaptive, chunk_size=chunk_size,
+                                                   cache_dir=null_cache_dir, cache_bytes=null_cache_bytes,
+                                                   schedule=schedule, window=window, sketch=sketch,
+                                                   cluster=cluster)
+                save_results(result, output_dir, text_export)
     
     print("\nMutual information and p-value calculation and saving complete.")
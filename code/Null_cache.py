@@ -0,0 +1,120 @@
+import os
+import json
+import fcntl
+import hashlib
+import tempfile
+from contextlib import contextmanager
+import numpy as np
+from Null_kernel import null_scheme
+
+# Persistent cache of shuffle-null MI values. The shuffled MI only depends on
+# the multiset of tokens, so every corpus is shuffled from its canonical form
+# (ids ranked by decreasing count) and the cache is keyed by a hash of the
+# sorted unigram counts, the base seed and the shuffle scheme of the null
+# kernel. Each entry holds a matrix of MI values (shuffle index x distance,
+# NaN when not computed yet), so a run with a larger max_d or more shuffles
+# only computes what is missing. The cache may sit on a disk shared by
+# concurrent runs: entries are written under unique temporary names and
+# replaced atomically, merges and evictions hold a lock file of the cache
+# directory, and entries removed by another run are treated as missing.
+def canonical_counts(counts):
+    counts = np.sort(np.asarray(counts, dtype=np.int64))[::-1]
+    return counts[counts > 0]
+
+def null_key(counts, seed, estimator=None):
+    # estimator: None for the exact MI, or the parameters of an approximate one
+    sha = hashlib.sha256(canonical_counts(counts).tobytes())
+    sha.update(str(seed).encode())
+    sha.update(str(null_scheme).encode())
+    if estimator is not None:
+        sha.update(json.dumps(estimator, sort_keys=True).encode())
+    return sha.hexdigest()[:32]
+
+def entry_path(cache_dir, key):
+    return os.path.join(cache_dir, f"{key}.npz")
+
+@contextmanager
+def cache_lock(cache_dir):
+    # lockf (POSIX record locks) also works over NFS
+    with open(os.path.join(cache_dir, '.lock'), 'a') as f:
+        fcntl.lockf(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.lockf(f, fcntl.LOCK_UN)
+
+def load_null(cache_dir, key):
+    path = entry_path(cache_dir, key)
+    try:
+        # Reading an entry counts as a use for the LRU eviction
+        os.utime(path)
+        with np.load(path) as entry:
+            return entry['shuffles'], entry['distances'], entry['values']
+    except FileNotFoundError:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64), np.zeros((0, 0))
+
+def positions(cached, wanted):
+    # Index of every wanted value in the sorted array cached, -1 when absent
+    if len(cached) == 0:
+        return np.full(len(wanted), -1)
+    index = np.minimum(np.searchsorted(cached, wanted), len(cached) - 1)
+    return np.where(cached[index] == wanted, index, -1)
+
+def lookup(cache_dir, key, shuffles, distances):
+    # (len(shuffles), len(distances)) matrix of cached values, NaN when missing
+    values = np.full((len(shuffles), len(distances)), np.nan)
+    cached_shuffles, cached_distances, cached_values = load_null(cache_dir, key)
+    rows = positions(cached_shuffles, shuffles)
+    cols = positions(cached_distances, distances)
+    values[np.ix_(rows >= 0, cols >= 0)] = cached_values[np.ix_(rows[rows >= 0], cols[cols >= 0])]
+    return values
+
+def store(cache_dir, key, shuffles, distances, values, max_bytes):
+    os.makedirs(cache_dir, exist_ok=True)
+    # The merge reads and rewrites the entry, so concurrent stores of the same
+    # key wait for each other instead of losing values
+    with cache_lock(cache_dir):
+        merge(cache_dir, key, shuffles, distances, values)
+        evict(cache_dir, max_bytes)
+
+def merge(cache_dir, key, shuffles, distances, values):
+    old_shuffles, old_distances, old_values = load_null(cache_dir, key)
+    all_shuffles = np.union1d(old_shuffles, shuffles)
+    all_distances = np.union1d(old_distances, distances)
+    merged = np.full((len(all_shuffles), len(all_distances)), np.nan)
+    merged[np.ix_(np.searchsorted(all_shuffles, old_shuffles), np.searchsorted(all_distances, old_distances))] = old_values
+    block = np.ix_(np.searchsorted(all_shuffles, shuffles), np.searchsorted(all_distances, distances))
+    merged[block] = np.where(np.isnan(values), merged[block], values)
+
+    fd, tmp_path = tempfile.mkstemp(suffix='.tmp.npz', dir=cache_dir)
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            np.savez(f, shuffles=all_shuffles, distances=all_distances, values=merged)
+        os.replace(tmp_path, entry_path(cache_dir, key))
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+def evict(cache_dir, max_bytes):
+    # Least recently used entries are removed until the cache fits in max_bytes
+    # (another run may remove an entry between the listing and its removal)
+    entries = []
+    for f in os.listdir(cache_dir):
+        if f.endswith('.npz') and not f.endswith('.tmp.npz'):
+            path = os.path.join(cache_dir, f)
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+    entries.sort()
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in entries:
+        if total <= max_bytes:
+            break
+        total -= size
+        try:
+            os.remove(path)
+            print(f"Evicted null cache entry {os.path.basename(path)}")
+        except FileNotFoundError:
+            pass
@@ -0,0 +1,186 @@
+import numpy as np
+
+try:
+    from numba import njit, prange
+except ImportError:
+    njit = None
+
+# Fused shuffle-and-count kernel of the permutation null. A shuffle orders
+# the positions by one splitmix64 key each, with the position stored in the
+# low bits of its key so that all keys are distinct and every sort gives the
+# same permutation. Entropies are summed over the histogram of the counts
+# (how many tokens or pairs occur c times), in increasing c, with one shared
+# log table, so the compiled kernel (Numba, when installed) and the NumPy
+# fallback give bit-identical MI values for identical seeds.
+null_scheme = 2  # Part of the null cache keys, changes when the shuffles change
+
+golden = np.uint64(0x9E3779B97F4A7C15)
+mix_1 = np.uint64(0xBF58476D1CE4E5B9)
+mix_2 = np.uint64(0x94D049BB133111EB)
+shift_1, shift_2, shift_3 = np.uint64(30), np.uint64(27), np.uint64(31)
+
+def stream_seed(seed):
+    # 64-bit seed of the shuffle seeded with the tuple seed
+    return np.random.SeedSequence(list(seed)).generate_state(1, np.uint64)[0]
+
+def log_tables(ids, distances):
+    # log(c) for every count c that can occur, and log(F) of every distance
+    max_count = np.bincount(ids).max() if len(ids) else 0
+    log_count = np.concatenate(([0.0], np.log(np.arange(1, max_count + 1, dtype=np.float64))))
+    return log_count, np.log((len(ids) - distances).astype(np.float64))
+
+def index_bits(N):
+    return np.uint64(max(int(N - 1).bit_length(), 1))
+
+# NumPy backend
+def shuffle_order(seed, N):
+    bits = index_bits(N)
+    index = np.arange(N, dtype=np.uint64)
+    z = seed + (index + np.uint64(1)) * golden
+    z = (z ^ (z >> shift_1)) * mix_1
+    z = (z ^ (z >> shift_2)) * mix_2
+    z = z ^ (z >> shift_3)
+    keys = (z >> bits << bits) | index
+    keys.sort()
+    return (keys & ((np.uint64(1) << bits) - np.uint64(1))).astype(np.int64)
+
+def histogram_xlogx(histogram, log_count):
+    # sum(c * log(c)) over the counts, from their histogram, left to right
+    terms = histogram * np.arange(len(histogram)) * log_count[:len(histogram)]
+    return np.cumsum(terms)[-1] if len(terms) else 0.0
+
+def null_rows_numpy(ids, seeds, distances, vocabulary_size, log_count, log_F):
+    N = len(ids)
+    rows = np.zeros((len(seeds), len(distances)))
+    keys = np.empty(N, dtype=np.int64)
+    for s, seed in enumerate(seeds):
+        shuffled = ids[shuffle_order(seed, N)]
+        for j, d in enumerate(distances):
+            F = N - d
+            Sx = histogram_xlogx(np.bincount(np.bincount(shuffled[:F])), log_count)
+            Sy = histogram_xlogx(np.bincount(np.bincount(shuffled[d:])), log_count)
+            pairs = keys[:F]
+            np.multiply(shuffled[:F], vocabulary_size, out=pairs)
+            pairs += shuffled[d:]
+            pairs.sort()
+            boundaries = np.flatnonzero(pairs[1:] != pairs[:-1]) + 1
+            runs = np.diff(np.concatenate(([0], boundaries, [F])))
+            Sxy = histogram_xlogx(np.bincount(runs), log_count)
+            rows[s, j] = log_F[j] - (Sx + Sy - Sxy) / F
+    return rows
+
+# Compiled backend: prange over the shuffles, and for every shuffle one set of
+# buffers reused by all its distances. The positions are grouped by their x
+# token once per shuffle, so the pairs of a distance are counted x group by x
+# group in a scratch array without any sort, and the marginal histograms are
+# updated incrementally as d grows.
+if njit is not None:
+    @njit(cache=True)
+    def histogram_xlogx_loop(histogram, log_count):
+        total = 0.0
+        for c in range(len(histogram)):
+            total += histogram[c] * c * log_count[c]
+        return total
+
+    @njit(cache=True)
+    def remove_token(counts, histogram, token):
+        c = counts[token]
+        histogram[c] -= 1
+        histogram[c - 1] += 1
+        counts[token] = c - 1
+
+    @njit(parallel=True, cache=True)
+    def null_rows_numba(ids, seeds, distances, vocabulary_size, log_count, log_F):
+        N = len(ids)
+        bits = 1
+        while (1 << bits) < N:
+            bits += 1
+        bits = np.uint64(bits)
+        low = (np.uint64(1) << bits) - np.uint64(1)
+        rows = np.zeros((len(seeds), len(distances)))
+        for s in prange(len(seeds)):
+            keys = np.empty(N, dtype=np.uint64)
+            for i in range(N):
+                z = seeds[s] + np.uint64(i + 1) * golden
+                z = (z ^ (z >> shift_1)) * mix_1
+                z = (z ^ (z >> shift_2)) * mix_2
+                z = z ^ (z >> shift_3)
+                keys[i] = (z >> bits << bits) | np.uint64(i)
+            keys.sort()
+            shuffled = np.empty(N, dtype=np.int64)
+            for i in range(N):
+                shuffled[i] = ids[np.int64(keys[i] & low)]
+
+            # Positions grouped by token, increasing within every group
+            starts = np.zeros(vocabulary_size + 1, dtype=np.int64)
+            for i in range(N):
+                starts[shuffled[i] + 1] += 1
+            for v in range(vocabulary_size):
+                starts[v + 1] += starts[v]
+            grouped = np.empty(N, dtype=np.int64)
+            fill = starts[:-1].copy()
+            for i in range(N):
+                grouped[fill[shuffled[i]]] = i
+                fill[shuffled[i]] += 1
+
+            x_counts = np.zeros(vocabulary_size, dtype=np.int64)
+            y_counts = np.zeros(vocabulary_size, dtype=np.int64)
+            x_histogram = np.zeros(len(log_count), dtype=np.int64)
+            y_histogram = np.zeros(len(log_count), dtype=np.int64)
+            xy_histogram = np.zeros(len(log_count), dtype=np.int64)
+            scratch = np.zeros(vocabulary_size, dtype=np.int64)
+            previous = 0
+            for j in range(len(distances)):
+                d = distances[j]
+                F = N - d
+                if j == 0:
+                    for i in range(F):
+                        x_counts[shuffled[i]] += 1
+                        y_counts[shuffled[i + d]] += 1
+                    for v in range(vocabulary_size):
+                        x_histogram[x_counts[v]] += 1
+                        y_histogram[y_counts[v]] += 1
+                else:
+                    # x loses its last tokens and y its first ones
+                    for i in range(F, N - previous):
+                        remove_token(x_counts, x_histogram, shuffled[i])
+                    for i in range(previous, d):
+                        remove_token(y_counts, y_histogram, shuffled[i])
+                previous = d
+
+                xy_histogram[:] = 0
+                for v in range(vocabulary_size):
+                    end = starts[v + 1]
+                    while end > starts[v] and grouped[end - 1] >= F:
+                        end -= 1
+                    for g in range(starts[v], end):
+                        scratch[shuffled[grouped[g] + d]] += 1
+                    for g in range(starts[v], end):
+                        y = shuffled[grouped[g] + d]
+                        if scratch[y] > 0:
+                            xy_histogram[scratch[y]] += 1
+                            scratch[y] = 0
+                Sx = histogram_xlogx_loop(x_histogram, log_count)
+                Sy = histogram_xlogx_loop(y_histogram, log_count)
+                Sxy = histogram_xlogx_loop(xy_histogram, log_count)
+                rows[s, j] = log_F[j] - (Sx + Sy - Sxy) / F
+        return rows
+
+backend = 'numba' if njit is not None else 'numpy'
+
+def null_rows(ids, seeds, distances, use=None):
+    # MI of the shuffles of ids with the given 64-bit seeds at the given
+    # (increasing) distances, as a (len(seeds), len(distances)) matrix
+    ids = np.asarray(ids, dtype=np.int64)
+    seeds = np.asarray(seeds, dtype=np.uint64)
+    distances = np.asarray(distances, dtype=np.int64)
+    # Distances without any pair keep an MI of 0, as in the sweep
+    rows = np.zeros((len(seeds), len(distances)))
+    valid = distances < len(ids)
+    if not valid.any():
+        return rows
+    vocabulary_size = int(ids.max()) + 1
+    log_count, log_F = log_tables(ids, distances[valid])
+    function = null_rows_numba if (use or backend) == 'numba' else null_rows_numpy
+    rows[:, valid] = function(ids, seeds, distances[valid], vocabulary_size, log_count, log_F)
+    return rows
@@ -0,0 +1,348 @@
+import os
+import json
+import queue
+import hashlib
+from collections import deque
+from functools import partial
+from itertools import count
+from multiprocessing import Pool, cpu_count
+
+import numpy as np
+import Fit_engine
+import Report
+import Run_log
+from Remove_boilerplate import clean_file
+from Tokenizer import language_code, tokenize_text, save_tokens, tokenizer_version
+from Mutual_information import (calculate_mi_and_p_values, check_schedule, check_window, distance_grid, finish_file,
+                                record_task, save_results, scheduled_task, schedule_file)
+from lengths import analyze_tokens_files
+from csv_to_latex import csv_to_latex
+from Results_store import list_corpora, store_path, text_suffixes
+from Token_store import binary_paths, stats_path
+
+# Incremental build of original -> no_boilerplate -> tokenized -> mi_results
+# -> plots/csv -> report and tables. The manifest records, for every job, the content
+# hashes of its inputs and its parameters; a job only runs again when one of
+# them changed or one of its outputs is missing.
+manifest_path = "data/manifest.json"
+
+def load_manifest():
+    if os.path.exists(manifest_path):
+        with open(manifest_path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    return {'hashes': {}, 'jobs': {}}
+
+def save_manifest(manifest):
+    with open(manifest_path + '.tmp', 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    os.replace(manifest_path + '.tmp', manifest_path)
+
+def file_hash(path, manifest):
+    # Hashes are reused while the size and modification time do not change
+    stat = os.stat(path)
+    cached = manifest['hashes'].get(path)
+    if cached and cached['size'] == stat.st_size and cached['mtime_ns'] == stat.st_mtime_ns:
+        return cached['sha256']
+    sha = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            sha.update(block)
+    manifest['hashes'][path] = {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'sha256': sha.hexdigest()}
+    return sha.hexdigest()
+
+def job_signature(job, params, manifest):
+    return {'inputs': {path: file_hash(path, manifest) for path in sorted(job['inputs'])},
+            'params': params, 'outputs': sorted(job['outputs'])}
+
+def is_up_to_date(job, signature, manifest):
+    return manifest['jobs'].get(job['key']) == signature and all(os.path.exists(p) for p in job['outputs'])
+
+def files_in(directory, suffix):
+    if not os.path.isdir(directory):
+        return []
+    return sorted(os.path.join(directory, f) for f in os.listdir(directory) if f.endswith(suffix))
+
+# Stage functions (module level so that pool workers can run them)
+def remove_boilerplate_job(input_path, output_path):
+    clean_file(input_path, output_path)
+
+def tokenize_job(input_path):
+    with open(input_path, 'r', encoding='utf-8') as f:
+        filename, tokens = tokenize_text((os.path.basename(input_path), f.read()))
+    save_tokens({filename: tokens})
+
+def mi_job(tokens_path, output_dir, max_d, num_shuffles, seed, schedule=None, window=None, sketch=None, pool=None):
+    result = calculate_mi_and_p_values(tokens_path, max_d, num_shuffles, pool=pool, seed=seed,
+                                       cache_dir="data/null_cache", schedule=schedule, window=window, sketch=sketch)
+    save_results(result, output_dir)
+
+def run_job(job, pool=None):
+    with Run_log.stage('job', key=job['key']):
+        if job.get('uses_pool'):
+            job['function'](*job['args'], pool=pool)
+        else:
+            job['function'](*job['args'])
+    return job['key']
+
+# Job lists of every stage, built when the stage starts so that they see the
+# outputs of the previous stages
+def boilerplate_jobs(params):
+    os.makedirs("data/no_boilerplate", exist_ok=True)
+    return [{'key': f"boilerplate:{path}", 'inputs': [path],
+             'outputs': [os.path.join("data/no_boilerplate", os.path.basename(path))],
+             'function': remove_boilerplate_job,
+             'args': (path, os.path.join("data/no_boilerplate", os.path.basename(path)))}
+            for path in files_in("data/original", ".txt")]
+
+def tokenize_jobs(params):
+    jobs = []
+    for path in files_in("data/no_boilerplate", ".txt"):
+        tokens_path = os.path.join("data/tokenized", f"{os.path.basename(path)}.tokens")
+        jobs.append({'key': f"tokenize:{path}", 'inputs': [path],
+                     'outputs': [tokens_path, *binary_paths(tokens_path), stats_path(tokens_path)],
+                     'function': tokenize_job, 'args': (path,)})
+    return jobs
+
+def lengths_jobs(params):
+    # The table only reads the statistics manifests, so those are its inputs
+    return [{'key': "lengths", 'inputs': [stats_path(path) for path in files_in("data/tokenized", ".tokens")],
+             'outputs': ["data/csv/lenghts.csv"],
+             'function': analyze_tokens_files, 'args': ("data/tokenized", "data/csv")}]
+
+def mi_job_of(path, params):
+    base = os.path.join("data/mi_results", os.path.basename(path))
+    return {'key': f"mi:{path}", 'inputs': [path],
+            'outputs': [f"{base}.npz"],
+            'function': mi_job, 'uses_pool': True,
+            'args': (path, "data/mi_results", params['max_d'], params['num_shuffles'], params['seed'],
+                     params['schedule'], params['window'], params['sketch'])}
+
+def mi_jobs(params):
+    return [mi_job_of(path, params) for path in files_in("data/tokenized", ".tokens")]
+
+def result_files(results_dir, corpus):
+    # The results store, or the old text files of corpora that predate it
+    if os.path.exists(store_path(results_dir, corpus)):
+        return [store_path(results_dir, corpus)]
+    paths = [os.path.join(results_dir, f"{corpus}{suffix}") for suffix in text_suffixes.values()]
+    return [path for path in paths if os.path.exists(path)]
+
+def fit_jobs(params):
+    corpora = list_corpora("data/mi_results") if os.path.isdir("data/mi_results") else []
+    inputs = [path for corpus in corpora for path in result_files("data/mi_results", corpus)]
+    plots = [Fit_engine.plot_path(variant, corpus) for variant in Fit_engine.plot_dirs for corpus in corpora]
+    os.makedirs("data/csv", exist_ok=True)
+    # One job: the fit engine loads every corpus once and spreads them over the pool
+    return [{'key': "fit", 'inputs': inputs, 'outputs': ["data/csv/fits.csv", *plots],
+             'function': Fit_engine.save_fits, 'uses_pool': True,
+             'args': (corpora, "data/mi_results", "data/csv/fits.csv", params['percentage'],
+                      params['resamples'], params['bootstrap_method'])}]
+
+def report_jobs(params):
+    # One job over all corpora; inside it only the tables whose rows changed are rendered
+    tokenized = files_in("data/tokenized", ".tokens")
+    languages = sorted({language_code(os.path.basename(path)) for path in tokenized})
+    inputs = [stats_path(path) for path in tokenized]
+    if os.path.exists("data/csv/fits.csv"):
+        inputs.append("data/csv/fits.csv")
+    os.makedirs("data/tables", exist_ok=True)
+    return [{'key': "report", 'inputs': inputs,
+             'outputs': [os.path.join("data/tables", f"{name}.tex")
+                         for name in ['languages', *(f"corpora_{language}" for language in languages)]],
+             'function': Report.write_report, 'args': ("data/tokenized", "data/csv/fits.csv", "data/tables")}]
+
+def table_jobs(params):
+    os.makedirs("data/tables", exist_ok=True)
+    return [{'key': f"table:{path}", 'inputs': [path],
+             'outputs': [os.path.join("data/tables", os.path.basename(path).replace('.csv', '.tex'))],
+             'function': csv_to_latex,
+             'args': (path, os.path.join("data/tables", os.path.basename(path).replace('.csv', '.tex')))}
+            for path in files_in("data/csv", ".csv")]
+
+# (stage name, job lists, parameters that invalidate its outputs, parallel over files)
+stages = [
+    ('boilerplate', boilerplate_jobs, [], True),
+    ('tokenize', tokenize_jobs, ['tokenizer_version'], True),
+    ('lengths', lengths_jobs, [], False),
+    # MI runs its files one at a time; their shuffles use the pool
+    ('mi', mi_jobs, ['max_d', 'schedule', 'window', 'sketch', 'num_shuffles', 'seed'], False),
+    ('fit', fit_jobs, ['percentage', 'resamples', 'bootstrap_method'], False),
+    ('report', report_jobs, [], False),
+    ('tables', table_jobs, [], True),
+]
+
+def stage_params(name, params):
+    return {p: params[p] for p in next(names for stage, _, names, _ in stages if stage == name)}
+
+def run_stage(name, make_jobs, param_names, parallel, params, pool, manifest):
+    jobs = make_jobs(params)
+    signatures = {job['key']: job_signature(job, stage_params(name, params), manifest) for job in jobs}
+    pending = [job for job in jobs if not is_up_to_date(job, signatures[job['key']], manifest)]
+    print(f"Stage {name}: {len(pending)} of {len(jobs)} jobs to run")
+
+    with Run_log.stage('pipeline_stage', pipeline_stage=name, jobs=len(jobs), pending=len(pending)):
+        if parallel:
+            completed = pool.imap_unordered(partial(Run_log.call_collected, run_job), pending)
+        else:
+            completed = ((run_job(job, pool), []) for job in pending)
+        # The manifest is saved after every job so that an interrupted run
+        # keeps what it already built
+        for key, job_records in Run_log.track(completed, f"Stage {name}", len(pending)):
+            Run_log.records.extend(job_records)
+            manifest['jobs'][key] = signatures[key]
+            save_manifest(manifest)
+
+# Streaming mode: the tokenize, MI and fit stages overlap instead of waiting
+# for each other. Every book moves through bounded queues: once tokenized it
+# waits for one of the stream_backlog MI slots (each holds a shared corpus),
+# or for the MI tasks to run out, its observed MI and shuffles run as pool
+# tasks, and it is fitted as soon as its last shuffle is done. All tasks share
+# the one pool; a free worker takes a fit first, then a book to tokenize while
+# the tokenizer is below its share of the workers, which shrinks as the MI
+# queue fills, then an MI task.
+streamed_stages = ('tokenize', 'mi', 'fit')
+
+def stream_books(params, pool, processes, manifest):
+    if params['sketch'] is not None:
+        raise ValueError("The streaming mode computes the exact MI; set sketch to None or streaming to False")
+    check_window(params['window'])
+    backlog = params['stream_backlog']
+    max_d, num_shuffles, schedule, window = params['max_d'], params['num_shuffles'], params['schedule'], params['window']
+    grid = distance_grid(max_d, schedule)
+    seed = np.random.SeedSequence(params['seed']).entropy
+    to_tokenize, mi_queue, mi_tasks, fit_queue = deque(), deque(), deque(), deque()
+    states, fits = {}, {}
+    indices = count()
+    running = {'tokenize': 0, 'mi': 0, 'fit': 0}
+    completed = queue.Queue()  # Filled by the pool's result thread
+
+    def submit(kind, payload, function, *args):
+        running[kind] += 1
+        pool.apply_async(function, args, callback=lambda result: completed.put((kind, payload, result)),
+                         error_callback=lambda error: completed.put(('error', kind, error)))
+
+    def commit(job, signature):
+        manifest['jobs'][job['key']] = signature
+        save_manifest(manifest)
+
+    def admit():
+        # Books leave the MI queue while MI slots are free, or while no MI task
+        # waits for a worker; up-to-date ones go straight to the fit queue
+        while mi_queue and (len(states) < backlog or not mi_tasks):
+            path = mi_queue.popleft()
+            job = mi_job_of(path, params)
+            signature = job_signature(job, stage_params('mi', params), manifest)
+            if is_up_to_date(job, signature, manifest):
+                fit_queue.append(os.path.basename(path))
+                continue
+            index = next(indices)
+            print(f"Scheduling {path}")
+            states[index], file_tasks = schedule_file(index, path, grid, num_shuffles, seed, "data/null_cache", window)
+            states[index].update(job=job, signature=signature)
+            mi_tasks.extend(file_tasks)
+
+    def fill():
+        while sum(running.values()) < processes:
+            share = processes * (1 - len(mi_queue) / backlog)
+            if fit_queue:
+                corpus = fit_queue.popleft()
+                submit('fit', corpus, partial(Run_log.call_collected, Fit_engine.fit_corpus),
+                       corpus, "data/mi_results", params['percentage'])
+            elif to_tokenize and (running['tokenize'] < share or not mi_tasks and len(mi_queue) < backlog):
+                job, signature = to_tokenize.popleft()
+                submit('tokenize', (job, signature), partial(Run_log.call_collected, run_job), job)
+            elif mi_tasks:
+                submit('mi', None, scheduled_task, mi_tasks.popleft())
+            else:
+                break
+
+    tokenize_params = stage_params('tokenize', params)
+    for job in tokenize_jobs(params):
+        signature = job_signature(job, tokenize_params, manifest)
+        if is_up_to_date(job, signature, manifest):
+            mi_queue.append(job['outputs'][0])
+        else:
+            to_tokenize.append((job, signature))
+    print(f"Streaming: {len(to_tokenize)} books to tokenize, {len(mi_queue)} already tokenized")
+    Fit_engine.make_output_dirs("data/csv/fits.csv")
+
+    with Run_log.stage('pipeline_stage', pipeline_stage='streaming', books=len(to_tokenize) + len(mi_queue)):
+        try:
+            while True:
+                admit()
+                fill()
+                if not any(running.values()):
+                    break
+                kind, payload, result = completed.get()
+                if kind == 'error':
+                    raise result
+                running[kind] -= 1
+                if kind == 'tokenize':
+                    _, task_records = result
+                    Run_log.records.extend(task_records)
+                    job, signature = payload
+                    commit(job, signature)
+                    mi_queue.append(job['outputs'][0])
+                elif kind == 'mi':
+                    index, k, value, elapsed, task_records = result
+                    Run_log.records.extend(task_records)
+                    state = states[index]
+                    if record_task(state, k, value, elapsed):
+                        del states[index]
+                        finish_file(state, grid, max_d, num_shuffles, seed, "data/mi_results", "data/null_cache",
+                                    schedule=schedule, window=window)
+                        commit(state['job'], state['signature'])
+                        fit_queue.append(os.path.basename(state['file_path']))
+                else:
+                    fits[payload], task_records = result
+                    Run_log.records.extend(task_records)
+                Run_log.record('stream_queues', to_tokenize=len(to_tokenize), mi_queue=len(mi_queue),
+                               mi_files=len(states), fit_queue=len(fit_queue), **running)
+        finally:
+            # Shared corpora of the books left in MI by an error
+            for state in states.values():
+                state['cleanup'].close()
+
+        # Corpora with results but no tokenized book (older runs) are fitted
+        # too, then the table is written in the usual order
+        job = fit_jobs(params)[0]
+        corpora = job['args'][0]
+        missing = [corpus for corpus in corpora if corpus not in fits]
+        fit = partial(Run_log.call_collected, partial(Fit_engine.fit_corpus, mi_results_dir="data/mi_results",
+                                                      percentage=params['percentage']))
+        fits.update(zip(missing, Run_log.gather(pool.imap(fit, missing))))
+        Fit_engine.write_fits([fits[corpus] for corpus in corpora], "data/csv/fits.csv",
+                              params['resamples'], params['bootstrap_method'])
+        commit(job, job_signature(job, stage_params('fit', params), manifest))
+
+def run_pipeline(params, pool, processes=None):
+    # A bad schedule is refused before the tokenize stage rather than at the first MI job
+    check_schedule(params['schedule'])
+    manifest = load_manifest()
+    for name, make_jobs, param_names, parallel in stages:
+        if params['streaming'] and name in streamed_stages:
+            if name == streamed_stages[0]:
+                stream_books(params, pool, processes or cpu_count(), manifest)
+            continue
+        run_stage(name, make_jobs, param_names, parallel, params, pool, manifest)
+
+if __name__ == "__main__":
+    params = {
+        'tokenizer_version': tokenizer_version,
+        'max_d': 30,  # Define maximum distance
+        'schedule': None,  # Distances below max_d (see distance_grid in Mutual_information)
+        'window': None,  # {'size': W, 'stride': S} for the sliding-window profile
+        'sketch': None,  # {'bytes': B per process, 'depth': r} for the approximate count-min joint entropies
+        'num_shuffles': 40,  # Define the number of shuffles for p-value calculation
+        'seed': 0,  # Define the base seed of the shuffles
+        'percentage': 0.01,  # Distance threshold of plot_2
+        'resamples': 2000,  # Bootstrap resamples of the Theil-Sen slopes
+        'bootstrap_method': 'both',  # 'distances', 'null' or 'both' (see Bootstrap)
+        'streaming': False,  # Overlap tokenize, MI and fit book by book (see stream_books)
+        'stream_backlog': 2,  # Tokenized books waiting for MI, and books in MI at once, in streaming mode
+    }
+    run_log_path = "data/run_log.json"  # Timings and memory of the run (None to disable)
+    processes = cpu_count()
+    with Run_log.run_log(run_log_path, 'Pipeline', **params), Pool(processes) as pool:
+        run_pipeline(params, pool, processes)
+    print("Pipeline complete.")
@@ -2,12 +2,18 @@ import os
 import numpy as np
 import matplotlib.pyplot as plt
 from scipy.stats import theilslopes
-
-def load_data(file_path):
-    return np.loadtxt(file_path)
-
-def plot_mi_d(mi_data, pvalues_data, avg_shuffled_mi_data, output_path, log_scale=True):
-    d_values = np.arange(1, len(mi_data))
+import Fit_engine
+import Run_log
+from Bootstrap import null_deviations
+from Results_store import list_corpora, load_results
+
+def significant_points(pvalues_data):
+    # Positions of the d > 0 values with p-value < 0.05
+    return pvalues_data[1:] < 0.05
+
+def plot_mi_d(mi_data, pvalues_data, avg_shuffled_mi_data, output_path, log_scale=True, distances=None):
+    # Distances of the result arrays (every d by default), without d = 0
+    d_values = np.arange(1, len(mi_data)) if distances is None else distances[1:]
     mi_values = mi_data[1:]  # Ignore the zero-distance value
     pvalues = pvalues_data[1:]  # Ignore the zero-distance value
     avg_shuffled_mi_values = avg_shuffled_mi_data[1:]  # Ignore the zero-distance value
@@ -18,13 +24,14 @@ def plot_mi_d(mi_data, pvalues_data, avg_shuffled_mi_data, output_path, log_scal
     plt.scatter(d_values, mi_values, color='red', label='p-value >= 0.05')
 
     # Highlight points with p-value < 0.05
-    significant = pvalues < 0.05
+    significant = significant_points(pvalues_data)
     plt.scatter(d_values[significant], mi_values[significant], color='blue', label='p-value < 0.05')
 
     # Plot the avg_shuffled_mi_data as an orange line
     plt.plot(d_values, avg_shuffled_mi_values, color='orange', label='Random MI', linestyle='-')
 
     # Perform Theil-Sen regression on log-transformed significant points
+    theil_sen_slope, theil_sen_intercept = np.nan, np.nan
     if np.any(significant):
         log_d_values = np.log(d_values[significant])
         log_mi_values = np.log(mi_values[significant])
@@ -58,44 +65,36 @@ def plot_mi_d(mi_data, pvalues_data, avg_shuffled_mi_data, output_path, log_scal
 
     return theil_sen_slope, theil_sen_intercept
 
-def save_theil_sen_data(mi_files, mi_results_dir, output_file):
-    with open(output_file, 'w') as f:
-        f.write("File,Slope,Intercept\n")
-        for mi_file in mi_files:
-            base_name = os.path.splitext(mi_file)[0]
-            mi_file_path = os.path.join(mi_results_dir, mi_file)
-            pvalues_file_path = os.path.join(mi_results_dir, f"{base_name}.pvalues")
-            avg_shuffled_mi_file_path = os.path.join(mi_results_dir, f"{base_name}.avg_shuffled_mi")
-            
-            mi_data = load_data(mi_file_path)
-            pvalues_data = load_data(pvalues_file_path)
-            avg_shuffled_mi_data = load_data(avg_shuffled_mi_file_path)
-            
-            output_plot_path = os.path.join("data/plots", f"{base_name}.png")
-            theil_sen_slope, theil_sen_intercept = plot_mi_d(mi_data, pvalues_data, avg_shuffled_mi_data, output_plot_path)
-            f.write(f"{base_name},{theil_sen_slope},{theil_sen_intercept}\n")
-    print(f"Theil-Sen data saved to {output_file}")
+def save_theil_sen_data(corpora, mi_results_dir, output_file, resamples=2000, method='both'):
+    fits = []
+    for base_name in corpora:
+        results = load_results(mi_results_dir, base_name, fields=('mi', 'p_values', 'avg_shuffled_mi', 'shuffled_mis'))
+
+        mi_data = results['mi']
+        pvalues_data = results['p_values']
+        avg_shuffled_mi_data = results['avg_shuffled_mi']
+
+        output_plot_path = os.path.join("data/plots", f"{base_name}.png")
+        with Run_log.stage('plot', corpus=base_name, output=output_plot_path):
+            theil_sen_slope, theil_sen_intercept = plot_mi_d(mi_data, pvalues_data, avg_shuffled_mi_data, output_plot_path, distances=results['distances'])
+        significant = significant_points(pvalues_data)
+        fits.append(([base_name, theil_sen_slope, theil_sen_intercept],
+                     [(results['distances'][1:][significant], mi_data[1:][significant],
+                       null_deviations(results, significant))]))
+
+    # Same 95% bootstrap interval of the slope as the Slope column of Fit_engine
+    Fit_engine.write_fits(fits, output_file, resamples, method,
+                          columns=['File', 'Slope', 'Slope_low', 'Slope_high', 'Intercept'])
 
 if __name__ == "__main__":
     mi_results_dir = "data/mi_results"
     output_plot_dir = "data/plots"
     output_theil_sen_file = "data/csv/theil_sen_data.csv"
     os.makedirs(output_plot_dir, exist_ok=True)
+    run_log_path = os.path.join(output_plot_dir, "run_log.json")  # None to disable
 
-    mi_files = [f for f in os.listdir(mi_results_dir) if f.endswith('.mi')]
-
-    for mi_file in mi_files:
-        base_name = os.path.splitext(mi_file)[0]
-        mi_file_path = os.path.join(mi_results_dir, mi_file)
-        pvalues_file_path = os.path.join(mi_results_dir, f"{base_name}.pvalues")
-        avg_shuffled_mi_file_path = os.path.join(mi_results_dir, f"{base_name}.avg_shuffled_mi")
-        
-        mi_data = load_data(mi_file_path)
-        pvalues_data = load_data(pvalues_file_path)
-        avg_shuffled_mi_data = load_data(avg_shuffled_mi_file_path)
-        
-        output_plot_path = os.path.join(output_plot_dir, f"{base_name}.png")
-        plot_mi_d(mi_data, pvalues_data, avg_shuffled_mi_data, output_plot_path)
+    corpora = list_corpora(mi_results_dir)
 
-    save_theil_sen_data(mi_files, mi_results_dir, output_theil_sen_file)
-    print("All plots and Theil-Sen data generated.")
+    with Run_log.run_log(run_log_path, 'Plots'):
+        save_theil_sen_data(corpora, mi_results_dir, output_theil_sen_file)
+        print("All plots and Theil-Sen data generated.")
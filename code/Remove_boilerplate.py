@@ -1,43 +1,78 @@
 import os
 import re
+from functools import partial
+from multiprocessing import Pool, cpu_count
+import Run_log
 
-def remove_gutenberg_boilerplate(file_path):
-    with open(file_path, 'r', encoding='utf-8') as file:
-        lines = file.readlines()
+start_marker = re.compile(r"\*\*\* ?START OF (THIS|THE) PROJECT GUTENBERG EBOOK", re.IGNORECASE)
+end_marker = re.compile(r"\*\*\* ?END OF (THIS|THE) PROJECT GUTENBERG EBOOK", re.IGNORECASE)
 
+def find_markers(file_path):
+    # Line numbers of the last START and END markers, None when missing;
+    # only lines that begin with '*' can match
     start_index = None
     end_index = None
-    for i, line in enumerate(lines):
-        if re.match(r"\*\*\* ?START OF (THIS|THE) PROJECT GUTENBERG EBOOK", line, re.IGNORECASE):
-            start_index = i
-        elif re.match(r"\*\*\* ?END OF (THIS|THE) PROJECT GUTENBERG EBOOK", line, re.IGNORECASE):
-            end_index = i
+    with open(file_path, 'r', encoding='utf-8') as file:
+        for i, line in enumerate(file):
+            if line.startswith('*'):
+                if start_marker.match(line):
+                    start_index = i
+                elif end_marker.match(line):
+                    end_index = i
+    return start_index, end_index
 
-    if start_index is not None and end_index is not None:
-        cleaned_lines = lines[start_index+1:end_index]
-        cleaned_text = ''.join(cleaned_lines)
-    else:
-        cleaned_text = ''.join(lines)
+def body_lines(file_path):
+    # Streams the lines between the markers, or every line when one is missing
+    start_index, end_index = find_markers(file_path)
+    keep_all = start_index is None or end_index is None
+    with open(file_path, 'r', encoding='utf-8') as file:
+        for i, line in enumerate(file):
+            if keep_all or start_index < i < end_index:
+                yield line
+            elif i >= end_index:
+                break
 
-    return cleaned_text
+def remove_gutenberg_boilerplate(file_path):
+    return ''.join(body_lines(file_path))
 
-def remove_gutenberg_boilerplate_from_folder(input_folder, output_folder):
+def clean_file(input_file_path, output_file_path):
+    # Two passes over the input, one line in memory at a time; the output is
+    # written under a temporary name so that an interrupted run leaves no
+    # partial file that looks up to date
+    with Run_log.stage('remove_boilerplate', file=os.path.basename(input_file_path)):
+        with open(output_file_path + '.tmp', 'w', encoding='utf-8') as file:
+            file.writelines(body_lines(input_file_path))
+        os.replace(output_file_path + '.tmp', output_file_path)
+    print(f"Boilerplate removed from: {os.path.basename(input_file_path)}")
+
+def is_up_to_date(input_file_path, output_file_path):
+    return os.path.exists(output_file_path) and os.path.getmtime(output_file_path) >= os.path.getmtime(input_file_path)
+
+def remove_gutenberg_boilerplate_from_folder(input_folder, output_folder, pool=None):
     # Create the output folder if it doesn't exist
-    if not os.path.exists(output_folder):
-        os.makedirs(output_folder)
+    os.makedirs(output_folder, exist_ok=True)
 
-    for filename in os.listdir(input_folder):
+    pending = []
+    for filename in sorted(os.listdir(input_folder)):
         if filename.endswith(".txt"):
             input_file_path = os.path.join(input_folder, filename)
             output_file_path = os.path.join(output_folder, filename)
-            cleaned_text = remove_gutenberg_boilerplate(input_file_path)
-            # Write the cleaned text to the output file
-            with open(output_file_path, 'w', encoding='utf-8') as file:
-                file.write(cleaned_text)
-            print(f"Boilerplate removed from: {filename}")
+            if is_up_to_date(input_file_path, output_file_path):
+                print(f"Up to date: {filename}")
+            else:
+                pending.append((input_file_path, output_file_path))
+
+    # Files are cleaned in parallel when a pool is given
+    clean = partial(Run_log.call_collected, clean_file)
+    completed = pool.starmap(clean, pending) if pool is not None else [clean(*paths) for paths in pending]
+    Run_log.gather(completed)
+
+if __name__ == "__main__":
+    input_folder_path = "data/original"
 
-input_folder_path = "data/original"
+    output_folder_path = "data/no_boilerplate"
 
-output_folder_path = "data/no_boilerplate"
+    run_log_path = os.path.join(output_folder_path, "run_log.json")  # None to disable
 
-remove_gutenberg_boilerplate_from_folder(input_folder_path, output_folder_path)
+    with Run_log.run_log(run_log_path, 'Remove_boilerplate'), Pool(cpu_count()) as pool:
+        remove_gutenberg_boilerplate_from_folder(input_folder_path, output_folder_path, pool)
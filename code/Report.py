@@ -0,0 +1,84 @@
+import os
+import hashlib
+import pandas as pd
+import Run_log
+from Token_store import load_corpus_stats
+
+# Batch report: the statistics manifests of the tokenized corpora and the fit
+# table are read once and joined by corpus into one frame, from which all the
+# LaTeX tables are cut (the corpora of every language, and a summary by
+# language). The first line of every table holds the hash of its rows, so a
+# table is only rendered again when its rows changed; a new corpus only
+# renders the table of its language and the summary (the fits and bootstrap
+# intervals of the other corpora do not depend on it, see Bootstrap).
+corpus_columns = ['Corpus', 'Tokens', 'Vocabulary', 'TTR', 'Slope', 'Slope_low', 'Slope_high',
+                  'Slope_2', 'Alpha']
+hash_prefix = "% rows sha256 "
+
+def corpus_name(file_name):
+    return file_name.replace('.txt.tokens', '')
+
+def load_stats(tokenized_dir):
+    rows = []
+    for file in sorted(os.listdir(tokenized_dir)):
+        if file.endswith('.tokens'):
+            stats = load_corpus_stats(os.path.join(tokenized_dir, file))
+            rows.append([corpus_name(file), stats['language'], stats['tokens'], stats['vocabulary'],
+                         stats['type_token_ratio']])
+    return pd.DataFrame(rows, columns=['Corpus', 'Language', 'Tokens', 'Vocabulary', 'TTR'])
+
+def load_fits(fits_file):
+    # Corpora without a fit table yet get empty fit columns
+    if not os.path.exists(fits_file):
+        return pd.DataFrame(columns=['Corpus'])
+    fits = pd.read_csv(fits_file)
+    fits.insert(0, 'Corpus', fits.pop('File').map(corpus_name))
+    return fits
+
+def load_report(tokenized_dir, fits_file):
+    report = load_stats(tokenized_dir).merge(load_fits(fits_file), on='Corpus', how='left')
+    return report.reindex(columns=['Language', *corpus_columns])
+
+def report_tables(report):
+    tables = {f"corpora_{language}": rows[corpus_columns] for language, rows in report.groupby('Language')}
+    tables['languages'] = report.groupby('Language').agg(
+        Corpora=('Corpus', 'size'), Tokens=('Tokens', 'sum'), TTR=('TTR', 'median'),
+        Slope=('Slope', 'median'), Slope_2=('Slope_2', 'median'), Alpha=('Alpha', 'median')).reset_index()
+    return tables
+
+def rows_hash(table):
+    return hashlib.sha256(table.to_csv(index=False).encode('utf-8')).hexdigest()
+
+def is_current(path, digest):
+    if not os.path.exists(path):
+        return False
+    with open(path, 'r', encoding='utf-8') as f:
+        return f.readline().strip() == hash_prefix + digest
+
+def write_report(tokenized_dir, fits_file, output_dir):
+    os.makedirs(output_dir, exist_ok=True)
+    with Run_log.stage('report_load'):
+        tables = report_tables(load_report(tokenized_dir, fits_file))
+    rendered = 0
+    for name, table in tables.items():
+        path = os.path.join(output_dir, f"{name}.tex")
+        digest = rows_hash(table)
+        if is_current(path, digest):
+            continue
+        with Run_log.stage('report_table', table=name, rows=len(table)):
+            latex = table.to_latex(index=False, float_format='%.4f', na_rep='--')
+            with open(path + '.tmp', 'w', encoding='utf-8') as f:
+                f.write(hash_prefix + digest + '\n' + latex)
+            os.replace(path + '.tmp', path)
+        rendered += 1
+    print(f"Report: {rendered} of {len(tables)} tables rendered")
+
+if __name__ == "__main__":
+    tokenized_dir = "data/tokenized"
+    fits_file = "data/csv/fits.csv"
+    output_dir = "data/tables"
+
+    run_log_path = os.path.join(output_dir, "report_run_log.json")  # None to disable
+
+    with Run_log.run_log(run_log_path, 'Report'):
+        write_report(tokenized_dir, fits_file, output_dir)
@@ -0,0 +1,95 @@
+import os
+import json
+import numpy as np
+
+# Results store: one uncompressed .npz per corpus in the results directory
+# (<book>.txt.tokens.npz) holding every array of a run. Along their last axis
+# the arrays follow the 'distances' array (every d from 0, or a sparser
+# schedule that still starts at 0); window_mi is the (window, distance) matrix
+# of the sliding-window profile, whose windows begin at window_starts, and
+# mi_error_bound the error bound of sketch-estimated MI. params and timings
+# are JSON strings.
+distance_fields = ['mi', 'p_values', 'avg_shuffled_mi', 'shuffled_mis', 'shuffles_used', 'window_mi',
+                   'mi_error_bound']
+text_suffixes = {'mi': '.mi', 'p_values': '.pvalues', 'avg_shuffled_mi': '.avg_shuffled_mi',
+                 'shuffles_used': '.shuffles_used'}
+
+def store_path(results_dir, corpus):
+    return os.path.join(results_dir, f"{corpus}.npz")
+
+def save_store(results_dir, corpus, arrays, params=None, timings=None):
+    os.makedirs(results_dir, exist_ok=True)
+    arrays = {name: np.asarray(value) for name, value in arrays.items() if value is not None}
+    arrays.setdefault('distances', np.arange(len(arrays['mi'])))
+    arrays['params'] = np.array(json.dumps(params or {}))
+    arrays['timings'] = np.array(json.dumps(timings or {}))
+    # Written under a temporary name so that readers never see a partial file
+    tmp_path = store_path(results_dir, corpus) + '.tmp.npz'
+    np.savez(tmp_path, **arrays)
+    os.replace(tmp_path, store_path(results_dir, corpus))
+
+def list_corpora(results_dir):
+    corpora = set()
+    for f in os.listdir(results_dir):
+        if f.endswith('.npz') and not f.endswith('.tmp.npz'):
+            corpora.add(f[:-len('.npz')])
+        elif f.endswith('.mi'):
+            corpora.add(f[:-len('.mi')])
+    return sorted(corpora)
+
+def load_text_results(results_dir, corpus):
+    # Old layout: one np.savetxt file per array
+    results = {}
+    for name, suffix in text_suffixes.items():
+        path = os.path.join(results_dir, f"{corpus}{suffix}")
+        if os.path.exists(path):
+            results[name] = np.atleast_1d(np.loadtxt(path))
+    results['distances'] = np.arange(len(results['mi']))
+    return results
+
+def load_results(results_dir, corpus, fields=None, d_min=None, d_max=None):
+    # Only the requested fields are read from the .npz, and the distance
+    # fields are cut to d_min <= d <= d_max
+    path = store_path(results_dir, corpus)
+    if os.path.exists(path):
+        with np.load(path) as store:
+            names = [n for n in store.files if fields is None or n in fields or n == 'distances']
+            results = {name: store[name] for name in names}
+    else:
+        results = {n: v for n, v in load_text_results(results_dir, corpus).items()
+                   if fields is None or n in fields or n == 'distances'}
+    for name in ('params', 'timings'):
+        if name in results:
+            results[name] = json.loads(str(results[name]))
+
+    distances = results['distances']
+    keep = np.ones(len(distances), dtype=bool)
+    if d_min is not None:
+        keep &= distances >= d_min
+    if d_max is not None:
+        keep &= distances <= d_max
+    for name in distance_fields + ['distances']:
+        if name in results:
+            results[name] = results[name][..., keep]
+    return results
+
+def load_all(results_dir, corpora=None, fields=None, d_min=None, d_max=None):
+    corpora = list_corpora(results_dir) if corpora is None else corpora
+    return {corpus: load_results(results_dir, corpus, fields, d_min, d_max) for corpus in corpora}
+
+def is_dense(distances):
+    # The text files index their values by d, so they can only hold every d from 0
+    return np.array_equal(distances, np.arange(len(distances)))
+
+def export_text(results_dir, corpus, output_dir=None):
+    # Compatibility exporter for the .mi/.pvalues/.avg_shuffled_mi text files
+    output_dir = results_dir if output_dir is None else output_dir
+    results = load_results(results_dir, corpus)
+    if not is_dense(results['distances']):
+        raise ValueError(f"{corpus}: the text files can only hold every distance from 0, "
+                         f"not the schedule {results['distances'].tolist()}")
+    os.makedirs(output_dir, exist_ok=True)
+    for name, suffix in text_suffixes.items():
+        if name in results:
+            np.savetxt(os.path.join(output_dir, f"{corpus}{suffix}"), results[name],
+                       fmt='%d' if name == 'shuffles_used' else '%.18e')
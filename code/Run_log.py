@@ -0,0 +1,153 @@
+import os
+import sys
+import json
+import time
+import resource
+from contextlib import contextmanager
+
+# Instrumentation shared by the scripts: wall time, CPU time and peak RSS of
+# named stages, progress lines with an ETA, and a JSON run log written next to
+# the results. Nothing is measured or printed unless a run log is open, so the
+# stages cost one flag test when it is disabled. Pool workers forked while the
+# log is open record too; call_collected sends their records back with the
+# task results.
+enabled = False
+records = []
+open_stages = []  # Peak RSS seen so far by every stage in progress
+progress_interval = 5.0  # Seconds between two progress lines
+
+def peak_rss_mb(who=resource.RUSAGE_SELF):
+    return resource.getrusage(who).ru_maxrss / 1024  # ru_maxrss is in KB on Linux
+
+def current_peak_mb():
+    # Peak RSS since the last reset (VmHWM), or of the whole process when
+    # /proc is not available
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return peak_rss_mb()
+
+def reset_peak():
+    # Writing 5 to clear_refs resets VmHWM to the current RSS
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        pass
+
+@contextmanager
+def stage(name, **fields):
+    if not enabled:
+        yield
+        return
+    # The peak of the enclosing stages is kept before the reset, so that a
+    # nested stage does not hide it
+    peak = current_peak_mb()
+    for outer in open_stages:
+        outer[0] = max(outer[0], peak)
+    reset_peak()
+    open_stages.append([0.0])
+    wall, cpu = time.perf_counter(), time.process_time()
+    try:
+        yield
+    finally:
+        peak = max(open_stages.pop()[0], current_peak_mb())
+        if open_stages:
+            open_stages[-1][0] = max(open_stages[-1][0], peak)
+        records.append({'stage': name, **fields, 'wall': time.perf_counter() - wall,
+                        'cpu': time.process_time() - cpu, 'peak_rss_mb': peak, 'pid': os.getpid()})
+
+def record(name, **fields):
+    if enabled:
+        records.append({'stage': name, **fields, 'pid': os.getpid()})
+
+@contextmanager
+def collected():
+    # Records made inside go to a separate list, returned to the caller
+    global records
+    outer, records = records, []
+    try:
+        yield records
+    finally:
+        records = outer
+
+@contextmanager
+def recording():
+    # Enables the stages without writing a run log and yields their records;
+    # pool workers forked inside record too
+    global enabled
+    outer = enabled
+    enabled = True
+    try:
+        with collected() as stage_records:
+            yield stage_records
+    finally:
+        enabled = outer
+
+def call_collected(function, *args):
+    # Runs a pool task and returns its result with the records it made
+    with collected() as task_records:
+        result = function(*args)
+    return result, task_records
+
+def gather(results):
+    # Inverse of call_collected in the parent process
+    values = []
+    for value, task_records in results:
+        records.extend(task_records)
+        values.append(value)
+    return values
+
+def track(iterable, label, total):
+    # Yields the items of iterable, printing done/total and an ETA at most
+    # every progress_interval seconds; total may be a function when it is
+    # only known as the tasks are created
+    if not enabled:
+        yield from iterable
+        return
+    start = last = time.perf_counter()
+    done = 0
+    for item in iterable:
+        yield item
+        done += 1
+        now = time.perf_counter()
+        expected = total() if callable(total) else total
+        if now - last >= progress_interval or done == expected:
+            last = now
+            eta = (now - start) / done * max(expected - done, 0)
+            print(f"{label}: {done}/{expected} ({100 * done / max(expected, 1):.0f}%), "
+                  f"elapsed {now - start:.0f}s, ETA {eta:.0f}s", flush=True)
+
+@contextmanager
+def run_log(path, script, **params):
+    # Opens the run log; path None leaves the instrumentation disabled
+    global enabled, records
+    if path is None:
+        yield
+        return
+    enabled, records = True, []
+    started = time.time()
+    wall, cpu = time.perf_counter(), time.process_time()
+    error = None
+    try:
+        with stage('run', script=script):
+            yield
+    except BaseException as e:
+        error = repr(e)
+        raise
+    finally:
+        enabled = False
+        log = {'script': script, 'argv': sys.argv, 'params': params,
+               'started': time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(started)),
+               'wall': time.perf_counter() - wall, 'cpu': time.process_time() - cpu,
+               'peak_rss_mb': peak_rss_mb(), 'children_peak_rss_mb': peak_rss_mb(resource.RUSAGE_CHILDREN),
+               'error': error, 'records': records}
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        with open(path + '.tmp', 'w', encoding='utf-8') as f:
+            json.dump(log, f, indent=1, default=str)
+        os.replace(path + '.tmp', path)
+        print(f"Run log written to {path}")
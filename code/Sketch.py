@@ -0,0 +1,60 @@
+import numpy as np
+from Null_kernel import golden, mix_1, mix_2, shift_1, shift_2, shift_3
+
+# Count-min sketch of the pair counts of one distance: depth rows of width
+# uint32 counters, one splitmix64 hash per row. A pair's count is estimated
+# by the minimum of its counters, which never underestimates it; in any one
+# row the other pairs add (F - c) / width to it on average. Since
+# sum(c*log(c)) over the pairs is the sum of log(c) over their F occurrences,
+# the joint term is estimated by a second pass that sums the log of the
+# estimated count of every occurrence. The estimate is only accurate when the
+# width is of the order of the number of distinct pairs or more.
+def sketch_width(sketch_bytes, depth, tables):
+    # Largest power of two that fits tables sketches in sketch_bytes
+    width = sketch_bytes // (4 * depth * max(tables, 1))
+    if width < 1:
+        raise ValueError(f"sketch_bytes={sketch_bytes} cannot hold {tables} sketches of depth {depth}")
+    return 1 << (int(width).bit_length() - 1)
+
+def new_sketch(depth, width):
+    return np.zeros((depth, width), dtype=np.uint32)
+
+def cells(keys, row, width):
+    z = keys.astype(np.uint64) + np.uint64((row + 1) * int(golden) % 2**64)
+    z = (z ^ (z >> shift_1)) * mix_1
+    z = (z ^ (z >> shift_2)) * mix_2
+    z = z ^ (z >> shift_3)
+    return (z & np.uint64(width - 1)).astype(np.int64)
+
+def add(sketch, keys):
+    depth, width = sketch.shape
+    for row in range(depth):
+        np.add(sketch[row], np.bincount(cells(keys, row, width), minlength=width), out=sketch[row], casting='unsafe')
+
+def estimate(sketch, keys):
+    depth, width = sketch.shape
+    counts = sketch[0][cells(keys, 0, width)]
+    for row in range(1, depth):
+        np.minimum(counts, sketch[row][cells(keys, row, width)], out=counts)
+    return counts
+
+def sum_log_estimates(sketch, keys):
+    return np.sum(np.log(estimate(sketch, keys).astype(np.float64)))
+
+def distinct_keys(sketch, F):
+    # Linear counting: a row with a fraction z of empty counters holds about
+    # -width * log(z) distinct keys (averaged over the rows); a row without
+    # empty counters only tells that there are at most F
+    _, width = sketch.shape
+    empty = np.count_nonzero(sketch == 0, axis=1)
+    if np.any(empty == 0):
+        return float(F)
+    return float(min(np.mean(-width * np.log(empty / width)), F))
+
+def entropy_error_bound(sketch, F):
+    # The estimate of H_XY is never above the exact value, and by Jensen its
+    # expected deficit, the mean of log(estimate / c) over the occurrences, is at most
+    # log(1 + K / width) for K distinct pairs (the minimum over the rows can
+    # only lower it); the estimated MI is high by the same amount
+    _, width = sketch.shape
+    return float(np.log1p(distinct_keys(sketch, F) / width))
@@ -0,0 +1,136 @@
+import os
+import json
+import hashlib
+import numpy as np
+from collections import Counter
+
+# Binary token corpus: a uint32 id array (.ids) that can be memory-mapped,
+# plus a vocabulary file (.vocab) with one "token<TAB>count" line per id.
+# Ids are assigned by decreasing frequency, so id 0 is the most common token.
+def binary_paths(tokens_path):
+    base = tokens_path[:-len('.tokens')] if tokens_path.endswith('.tokens') else tokens_path
+    return f"{base}.ids", f"{base}.vocab"
+
+def encode_by_frequency(tokens):
+    counts = Counter(tokens).most_common()
+    index = {token: i for i, (token, _) in enumerate(counts)}
+    ids = np.fromiter((index[t] for t in tokens), dtype=np.uint32, count=len(tokens))
+    return ids, counts
+
+def save_binary_tokens(tokens, tokens_path):
+    ids_path, vocab_path = binary_paths(tokens_path)
+    ids, counts = encode_by_frequency(tokens)
+    ids.tofile(ids_path)
+    with open(vocab_path, 'w', encoding='utf-8') as f:
+        for token, count in counts:
+            f.write(f"{token}\t{count}\n")
+    return counts
+
+def has_binary_tokens(tokens_path):
+    return all(os.path.exists(path) for path in binary_paths(tokens_path))
+
+def load_ids(tokens_path):
+    # O(1) memory-mapped view when the binary form exists, otherwise the
+    # text file is split and encoded
+    ids_path, _ = binary_paths(tokens_path)
+    if has_binary_tokens(tokens_path):
+        if os.path.getsize(ids_path) == 0:
+            return np.zeros(0, dtype=np.uint32)
+        return np.memmap(ids_path, dtype=np.uint32, mode='r')
+    with open(tokens_path, 'r', encoding='utf-8') as f:
+        ids, _ = encode_by_frequency(f.read().split())
+    return ids
+
+def load_vocabulary(tokens_path):
+    _, vocab_path = binary_paths(tokens_path)
+    tokens, counts = [], []
+    with open(vocab_path, 'r', encoding='utf-8') as f:
+        for line in f:
+            token, count = line.rstrip('\n').rsplit('\t', 1)
+            tokens.append(token)
+            counts.append(int(count))
+    return tokens, np.array(counts, dtype=np.int64)
+
+def load_tokens(tokens_path):
+    if has_binary_tokens(tokens_path):
+        vocabulary, _ = load_vocabulary(tokens_path)
+        return [vocabulary[i] for i in load_ids(tokens_path)]
+    with open(tokens_path, 'r', encoding='utf-8') as f:
+        return f.read().split()
+
+def corpus_length(tokens_path):
+    ids_path, _ = binary_paths(tokens_path)
+    if has_binary_tokens(tokens_path):
+        return os.path.getsize(ids_path) // np.dtype(np.uint32).itemsize
+    return len(load_ids(tokens_path))
+
+def iter_id_chunks(tokens_path, chunk_size=2**22):
+    # Streams the corpus as integer id arrays of about chunk_size tokens
+    if has_binary_tokens(tokens_path):
+        ids = load_ids(tokens_path)
+        for start in range(0, len(ids), chunk_size):
+            yield np.asarray(ids[start:start + chunk_size], dtype=np.int64)
+        return
+
+    # Text files are read in blocks and encoded with a vocabulary built on the fly
+    index = {}
+    rest = ''
+    with open(tokens_path, 'r', encoding='utf-8') as f:
+        while True:
+            block = f.read(chunk_size * 8)
+            if not block:
+                break
+            block = rest + block
+            tokens = block.split()
+            # The last token may continue in the next block
+            rest = tokens.pop() if tokens and not block[-1].isspace() else ''
+            yield np.fromiter((index.setdefault(t, len(index)) for t in tokens), dtype=np.int64, count=len(tokens))
+    if rest:
+        yield np.array([index.setdefault(rest, len(index))], dtype=np.int64)
+
+# Corpus statistics manifest (.stats.json), written by the tokenizer from the
+# counts it already has, so that the lengths table and the MI scheduler never
+# read the token files to size a corpus
+def stats_path(tokens_path):
+    base = tokens_path[:-len('.tokens')] if tokens_path.endswith('.tokens') else tokens_path
+    return f"{base}.stats.json"
+
+def source_hash(path):
+    if not os.path.exists(path):
+        return None
+    sha = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+def corpus_statistics(counts, language, source_sha256=None, top_k=50):
+    # counts: (token, count) pairs by decreasing count
+    num_tokens = sum(count for _, count in counts)
+    return {'language': language, 'tokens': num_tokens, 'vocabulary': len(counts),
+            'type_token_ratio': len(counts) / num_tokens if num_tokens else 0.0,
+            'top': [[token, count] for token, count in counts[:top_k]], 'source_sha256': source_sha256}
+
+def save_corpus_stats(tokens_path, stats):
+    path = stats_path(tokens_path)
+    with open(path + '.tmp', 'w', encoding='utf-8') as f:
+        json.dump(stats, f, ensure_ascii=False, indent=1)
+    os.replace(path + '.tmp', path)
+
+def load_corpus_stats(tokens_path):
+    path = stats_path(tokens_path)
+    if os.path.exists(path):
+        with open(path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    # Corpora tokenized before the manifest existed: the statistics are
+    # computed once from the vocabulary (or the tokens) and saved. The
+    # language is the ISO prefix of the filename, as in the tokenizer.
+    if has_binary_tokens(tokens_path):
+        tokens, counts = load_vocabulary(tokens_path)
+        counts = list(zip(tokens, counts.tolist()))
+    else:
+        with open(tokens_path, 'r', encoding='utf-8') as f:
+            counts = Counter(f.read().split()).most_common()
+    stats = corpus_statistics(counts, os.path.basename(tokens_path).split('_', 1)[0])
+    save_corpus_stats(tokens_path, stats)
+    return stats
@@ -1,14 +1,42 @@
 import os
 import re
-import spacy
-import jieba
+import resource
+import time
+import unicodedata
+from functools import partial
 from multiprocessing import Pool, cpu_count
-from spacy.lang.ru import Russian
-nlp_ru= Russian()
-# Load Spacy models
-nlp_es = spacy.load('es_core_news_sm')
-nlp_en = spacy.load('en_core_web_sm')
-nlp_fi= spacy.load("fi_core_news_sm") 
+import Run_log
+from Run_log import peak_rss_mb
+from Token_store import corpus_statistics, save_binary_tokens, save_corpus_stats, source_hash
+
+start_time = time.perf_counter()
+
+# Bump when a change alters the tokens produced, so that the pipeline
+# manifest invalidates the tokenized corpora
+tokenizer_version = 3
+
+# Pipeline components that are never used: only the tokenizer and the
+# lexical attributes of the tokens are needed
+unused_components = ['tok2vec', 'morphologizer', 'tagger', 'parser', 'senter', 'attribute_ruler',
+                     'lemmatizer', 'trainable_lemmatizer', 'ner']
+
+def load_spacy_model(name):
+    import spacy
+    return spacy.load(name, exclude=unused_components)
+
+def load_russian():
+    from spacy.lang.ru import Russian
+    return Russian()
+
+def load_japanese():
+    # Offline Sudachi segmenter (sudachipy + sudachidict_core)
+    from spacy.lang.ja import Japanese
+    return Japanese()
+
+def load_jieba():
+    import jieba
+    jieba.initialize()
+    return jieba
 
 # Extracts raw text from each file 
 codes_langs = ['zh','es', 'en', 'ru', 'ja', 'fi'] #ISO code of languages: chinese, spanish, english, russian, japanese.
@@ -17,7 +45,7 @@ def extract_raw_texts(list_of_codes):
     path = "data/no_boilerplate/"
     all_file_names = [file for file in os.listdir(path) if file.endswith('.txt')] # enlists names of .txt files 
     for language in list_of_codes:
-        files = [f for f in all_file_names if re.findall(language, f)] # separating files by language 
+        files = [f for f in all_file_names if language_code(f) == language] # separating files by language 
         for f in files:
             with open(path + f, "r", encoding="utf-8") as file:
                 raw = file.read()
@@ -25,46 +53,143 @@ def extract_raw_texts(list_of_codes):
             print(f"Extracted raw text from {f}")
     return raw_files_texts
 
-# Tokenizer function
-def tokenizer(text, model_lang):
+# Splits a text at blank lines, and paragraphs longer than max_chars at
+# their last line break (or other whitespace) before max_chars, so that no
+# piece reaches nlp.max_length; token boundaries never cross whitespace, so
+# the tokens of the pieces are the tokens of the whole text
+max_paragraph_chars = 100000
+whitespace = re.compile(r'\s')
+
+def split_long(paragraph, max_chars):
+    while len(paragraph) > max_chars:
+        cut = paragraph.rfind('\n', 0, max_chars)
+        if cut <= 0:
+            cut = max(paragraph.rfind(' ', 0, max_chars), paragraph.rfind('\t', 0, max_chars))
+        if cut <= 0:
+            # No whitespace before max_chars: cut at the first one after it
+            space = whitespace.search(paragraph, max_chars)
+            if space is None:
+                break
+            cut = space.start()
+        yield paragraph[:cut]
+        paragraph = paragraph[cut:]
+    yield paragraph
+
+def split_paragraphs(text, max_chars=max_paragraph_chars):
+    return [piece for paragraph in re.split(r'\n\s*\n', text) if paragraph.strip()
+            for piece in split_long(paragraph, max_chars) if piece.strip()]
+
+# Tokenizer function: paragraphs are streamed through nlp.pipe with every
+# pipeline component disabled, since only token.text and the lexical
+# is_space/is_punct/is_digit flags are used
+def tokenizer(text, model_lang, batch_size=256, n_process=1, pieces=None):
     nlp = model_lang
-    nlp.max_length = 9000000
-    doc = nlp(text)
-    tokens = [token.text for token in doc if not token.is_space and not token.is_punct and not token.is_digit]
+    tokens = []
+    if pieces is None:
+        pieces = split_paragraphs(text)
+    with nlp.select_pipes(disable=nlp.pipe_names):
+        for doc in nlp.pipe(pieces, batch_size=batch_size, n_process=n_process):
+            tokens.extend(token.text for token in doc if not token.is_space and not token.is_punct and not token.is_digit)
     return tokens
 
-def tokenize_text(item):
+# CJK texts have no blank-line structure to rely on, so they are cut right
+# after sentence-final punctuation or line breaks, packing sentences into
+# pieces of at most max_chars characters
+cjk_languages = {'zh', 'ja'}
+sentence_end = re.compile(r'(?<=[。！？!?\n])')
+
+def split_sentences(text, max_chars):
+    pieces, current, size = [], [], 0
+    for sentence in sentence_end.split(text):
+        if size + len(sentence) > max_chars and current:
+            pieces.append(''.join(current))
+            current, size = [], 0
+        # Sentences longer than max_chars are cut where they overflow
+        while len(sentence) > max_chars:
+            pieces.append(sentence[:max_chars])
+            sentence = sentence[max_chars:]
+        current.append(sentence)
+        size += len(sentence)
+    if current:
+        pieces.append(''.join(current))
+    return pieces
+
+punc = frozenset(["\n", ", "," ","，",": ",'。',"-",":", "(",")","'","\"","」","「",
+                  "？","﹔","　","：","！","、","《","》","』","『","[","]"])
+
+def is_punctuation(token):
+    return token in punc or all(ch.isspace() or unicodedata.category(ch).startswith('P') for ch in token)
+
+def tokenize_chinese(text, jieba, batch_size=256, n_process=1):
+    tok = jieba.lcut(text, cut_all=False)
+    return [t for t in tok if not is_punctuation(t)]
+
+def tokenize_japanese(text, nlp, batch_size=256, n_process=1):
+    # Sudachi rejects inputs over ~49 KB, so the text goes in sentence pieces
+    return tokenizer(text, nlp, batch_size, n_process, pieces=split_sentences(text, 4000))
+
+# Language handlers keyed on the ISO prefix of the filename (es_book1.txt -> es):
+# a loader for the model and the tokenizer that uses it
+language_handlers = {
+    'es': (partial(load_spacy_model, 'es_core_news_sm'), tokenizer),
+    'en': (partial(load_spacy_model, 'en_core_web_sm'), tokenizer),
+    'fi': (partial(load_spacy_model, 'fi_core_news_sm'), tokenizer),
+    'ru': (load_russian, tokenizer),
+    'zh': (load_jieba, tokenize_chinese),
+    'ja': (load_japanese, tokenize_japanese),
+}
+
+# Models are loaded on first use and stay cached in the process, so a worker
+# only holds the models of the languages it actually tokenizes
+loaded_models = {}
+
+def get_model(code):
+    if code not in loaded_models:
+        load_start = time.perf_counter()
+        with Run_log.stage('load_model', language=code):
+            loaded_models[code] = language_handlers[code][0]()
+        print(f"Loaded {code} model in {time.perf_counter() - load_start:.2f}s (pid {os.getpid()})")
+    return loaded_models[code]
+
+def language_code(filename):
+    return filename.split('_', 1)[0]
+
+def tokenize_text(item, batch_size=256, n_process=1):
     filename, text = item
     print(f"Tokenizing {filename}...")
-    if 'es' in filename:
-        model_lang = nlp_es
-        tokens = tokenizer(text, model_lang)
-    elif 'en' in filename:
-        model_lang = nlp_en
-        tokens = tokenizer(text, model_lang)
-    elif 'fi' in filename:
-        model_lang= nlp_fi
-        tokens= tokenizer(text, model_lang)
-    elif 'zh' in filename:
-        punc = ["\n", ", "," ","，",": ",'。',"-",":", "(",")","'","\"","」","「",
-                "？","﹔","　","：","！","、","《","》","』","『","[","]"]
-        tok = jieba.lcut(text, cut_all=False)
-        tokens = [t for t in tok if t not in punc]
-    elif 'ru' in filename:
-        model_lang = nlp_ru
-        tokens = tokenizer(text, model_lang)
+    code = language_code(filename)
+    if code in language_handlers:
+        model = get_model(code)
+        with Run_log.stage('tokenize', file=filename, characters=len(text)):
+            tokens = language_handlers[code][1](text, model, batch_size, n_process)
     else:
         tokens = []  # If language is not matched
     print(f"Finished tokenizing {filename}")
     return filename, tokens
 
-def save_tokens(tokens_langs):
+def split_cjk_books(items, max_chars):
+    # CJK books are cut at sentence ends so that their pieces are segmented
+    # in parallel; pool.map keeps the pieces in order
+    tasks = []
+    for filename, text in items:
+        if language_code(filename) in cjk_languages:
+            tasks.extend((filename, piece) for piece in split_sentences(text, max_chars))
+        else:
+            tasks.append((filename, text))
+    return tasks
+
+def save_tokens(tokens_langs, source_dir="data/no_boilerplate"):
     output_dir = "data/tokenized"
     os.makedirs(output_dir, exist_ok=True)
     for filename, tokens in tokens_langs.items():
         save_path = os.path.join(output_dir, f"{filename}.tokens")
         with open(save_path, 'w', encoding='utf-8') as f:
             f.write(' '.join(tokens))
+        # Compact binary form (uint32 ids + vocabulary) for np.memmap loaders
+        counts = save_binary_tokens(tokens, save_path)
+        # Statistics manifest from the same counts, with the hash of the source text
+        save_corpus_stats(save_path, corpus_statistics(counts, language_code(filename),
+                                                       source_hash(os.path.join(source_dir, filename))))
         print(f"Saved tokenized text for {filename}")
 
 if __name__ == "__main__":
@@ -72,15 +197,37 @@ if __name__ == "__main__":
     raw_texts = extract_raw_texts(codes_langs)
     items = list(raw_texts.items())
 
-    # Use multiprocessing to parallelize tokenization
+    batch_size = 256  # Paragraphs per nlp.pipe batch
+    n_process = 1  # Processes per book in nlp.pipe
+    cjk_chunk_chars = 50000  # Characters per parallel piece of a Chinese or Japanese book
+    run_log_path = "data/tokenized/run_log.json"  # Timings and memory of the run (None to disable)
+
+    # Use multiprocessing to parallelize tokenization: across books, or inside
+    # each book when nlp.pipe runs its own processes
+    print(f"Startup time: {time.perf_counter() - start_time:.2f}s")
     print("Starting tokenization...")
-    with Pool(cpu_count()) as pool:
-        results = pool.map(tokenize_text, items)
+    tokenize = partial(tokenize_text, batch_size=batch_size, n_process=n_process)
+    tasks = split_cjk_books(items, cjk_chunk_chars)
+    with Run_log.run_log(run_log_path, 'Tokenizer', batch_size=batch_size, n_process=n_process,
+                         cjk_chunk_chars=cjk_chunk_chars, tokenizer_version=tokenizer_version):
+        if n_process > 1:
+            results = [tokenize(task) for task in tasks]
+        else:
+            with Pool(cpu_count()) as pool:
+                # The workers send their stage records back with the tokens
+                results = Run_log.gather(Run_log.track(pool.imap(partial(Run_log.call_collected, tokenize), tasks),
+                                                       "Tokenized pieces", len(tasks)))
 
-    # Convert results to dictionary
-    tokens_langs = {filename: tokens for filename, tokens in results}
+        # Convert results to dictionary, joining the pieces of each book
+        tokens_langs = {}
+        for filename, tokens in results:
+            tokens_langs.setdefault(filename, []).extend(tokens)
 
-    # Save the tokenized texts
-    print("Saving tokenized texts...")
-    save_tokens(tokens_langs)
+        # Save the tokenized texts
+        print("Saving tokenized texts...")
+        with Run_log.stage('save_tokens', files=len(tokens_langs)):
+            save_tokens(tokens_langs)
     print("Tokenization and saving complete.")
+    print(f"Total time: {time.perf_counter() - start_time:.2f}s")
+    print(f"Peak resident memory: main process {peak_rss_mb():.0f} MB, "
+          f"largest worker {peak_rss_mb(resource.RUSAGE_CHILDREN):.0f} MB")
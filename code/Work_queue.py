@@ -0,0 +1,269 @@
+import os
+import sys
+import hashlib
+import time
+import queue
+import tempfile
+import threading
+from collections import deque
+from contextlib import contextmanager
+from multiprocessing import Process, cpu_count
+from multiprocessing.managers import BaseManager
+import numpy as np
+import Run_log
+from Null_cache import canonical_counts
+from Null_kernel import null_rows, stream_seed
+
+# Work queue of the shuffle null across machines, with nothing beyond the
+# standard library: the coordinator serves a Dispatcher through a
+# multiprocessing manager over TCP, and workers on any machine ask it for
+# (corpus, distances, seed) tasks, fetch every corpus once into a local
+# memory-mapped file and send back the MI rows. A shared corpus is the
+# canonical multiset of its unigram counts, so it is keyed by their hash and
+# workers keep their copy across the batches of an adaptive run. A task whose worker reports
+# an error, or does not answer before its lease expires, is handed out again
+# up to max_attempts times. A row only depends on its seed, so retried or
+# duplicated tasks give the same values as the local pool.
+part_bytes = 2**26  # Bytes of corpus sent per request
+poll_seconds = 0.5  # Wait of an idle worker before asking again
+authkey_variable = 'MI_CLUSTER_AUTHKEY'
+min_authkey_length = 16
+
+def cluster_authkey():
+    # Manager connections unpickle what they receive, so whoever holds the key
+    # can run code on the coordinator (or, posing as one, on the workers): it
+    # is a secret shared through the environment, never a default
+    authkey = os.environ.get(authkey_variable, '')
+    if len(authkey) < min_authkey_length:
+        raise RuntimeError(f"Set {authkey_variable} to the same secret of at least {min_authkey_length} "
+                           f"characters on the coordinator and the workers, e.g. the output of "
+                           f"python -c 'import secrets; print(secrets.token_hex(32))'")
+    return authkey.encode()
+
+def check_authkey(authkey):
+    if not authkey or len(authkey) < min_authkey_length:
+        raise ValueError(f"The cluster authkey must have at least {min_authkey_length} bytes")
+
+def corpus_key(corpus, counts):
+    # Equal keys mean equal files, whichever run or batch shared them
+    sha = hashlib.sha256(canonical_counts(counts).tobytes())
+    sha.update(np.dtype(corpus[2]).str.encode())
+    return f"mi_corpus_{sha.hexdigest()[:32]}{os.path.splitext(corpus[0])[1]}"
+
+class QueueManager(BaseManager):
+    pass
+
+class Dispatcher:
+    def __init__(self, lease_seconds=600, max_attempts=3):
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self.lock = threading.Lock()
+        self.corpora = {}  # key -> (path, length, dtype)
+        self.corpus_runs = {}  # key -> number of runs using the corpus
+        self.tasks = {}  # task id -> (corpus key, distances, seed)
+        self.pending = deque()
+        self.leases = {}  # task id -> deadline
+        self.attempts = {}
+        self.done = set()
+        self.results = queue.Queue()  # (task id, values, error)
+        self.next_id = 0
+        self.closed = False
+
+    # Worker side (exposed through the manager)
+    def get_task(self):
+        # A task, None when there is nothing to do yet, 'stop' once closed
+        with self.lock:
+            if self.closed:
+                return 'stop'
+            self.expire_leases()
+            if not self.pending:
+                return None
+            task_id = self.pending.popleft()
+            self.leases[task_id] = time.monotonic() + self.lease_seconds
+            self.attempts[task_id] += 1
+            key, distances, seed = self.tasks[task_id]
+            _, length, dtype = self.corpora[key]
+            return task_id, key, length, dtype, distances, seed
+
+    def corpus_part(self, key, offset):
+        path, _, _ = self.corpora[key]
+        with open(path, 'rb') as f:
+            f.seek(offset)
+            return f.read(part_bytes)
+
+    def put_result(self, task_id, values):
+        with self.lock:
+            # The first answer wins, even from an expired lease (every attempt
+            # gives the same row); later answers, and answers to tasks of
+            # finished runs, are dropped
+            if task_id in self.done or task_id not in self.tasks:
+                return
+            self.done.add(task_id)
+            self.leases.pop(task_id, None)
+            if task_id in self.pending:
+                self.pending.remove(task_id)
+            self.results.put((task_id, values, None))
+
+    def put_error(self, task_id, error):
+        with self.lock:
+            if task_id in self.leases:
+                del self.leases[task_id]
+                self.retry(task_id, error)
+
+    # Coordinator side
+    def retry(self, task_id, error):
+        if self.attempts[task_id] >= self.max_attempts:
+            self.done.add(task_id)
+            self.results.put((task_id, None, error))
+        else:
+            print(f"Retrying shuffle task {task_id} ({error})")
+            self.pending.append(task_id)
+
+    def expire_leases(self):
+        now = time.monotonic()
+        for task_id, deadline in list(self.leases.items()):
+            if deadline < now:
+                del self.leases[task_id]
+                self.retry(task_id, f"lease of {self.lease_seconds}s expired")
+
+    def run(self, corpus, counts, tasks):
+        # Rows of the (corpus, distances, seed) tasks in their order, with the
+        # corpus given as (path, length, dtype) of its memory-mapped file,
+        # written by shared_corpus from the unigram counts
+        key = corpus_key(corpus, counts)
+        with self.lock:
+            self.corpora[key] = corpus
+            self.corpus_runs[key] = self.corpus_runs.get(key, 0) + 1
+            ids = list(range(self.next_id, self.next_id + len(tasks)))
+            self.next_id += len(tasks)
+            for task_id, (_, distances, seed) in zip(ids, tasks):
+                self.tasks[task_id] = (key, np.asarray(distances), seed)
+                self.attempts[task_id] = 0
+                self.pending.append(task_id)
+        rows = {}
+        try:
+            for _ in Run_log.track(range(len(ids)), "Shuffles", len(ids)):
+                while True:
+                    try:
+                        task_id, values, error = self.results.get(timeout=poll_seconds)
+                        break
+                    except queue.Empty:
+                        with self.lock:
+                            self.expire_leases()
+                if error is not None:
+                    raise RuntimeError(f"Shuffle task {task_id} failed {self.max_attempts} times: {error}")
+                rows[task_id] = values
+        finally:
+            with self.lock:
+                for task_id in ids:
+                    self.tasks.pop(task_id, None)
+                    self.attempts.pop(task_id, None)
+                    self.leases.pop(task_id, None)
+                    self.done.discard(task_id)
+                self.pending = deque(t for t in self.pending if t in self.tasks)
+                self.corpus_runs[key] -= 1
+                if self.corpus_runs[key] == 0:
+                    del self.corpora[key], self.corpus_runs[key]
+        return [rows[task_id] for task_id in ids]
+
+    def close(self):
+        with self.lock:
+            self.closed = True
+
+@contextmanager
+def coordinator(address, authkey, lease_seconds=600, max_attempts=3):
+    # Serves a Dispatcher on address (host, port) from a thread of this process
+    check_authkey(authkey)
+    dispatcher = Dispatcher(lease_seconds, max_attempts)
+    QueueManager.register('dispatcher', callable=lambda: dispatcher,
+                          exposed=('get_task', 'corpus_part', 'put_result', 'put_error'))
+    server = QueueManager(address=address, authkey=authkey).get_server()
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    print(f"Shuffle coordinator listening on {server.address[0]}:{server.address[1]}")
+    try:
+        yield dispatcher
+    finally:
+        dispatcher.close()
+
+def connect(address, authkey, timeout):
+    # The coordinator may start after the workers
+    check_authkey(authkey)
+    QueueManager.register('dispatcher')
+    deadline = time.monotonic() + timeout
+    while True:
+        manager = QueueManager(address=address, authkey=authkey)
+        try:
+            manager.connect()
+            return manager.dispatcher()
+        except ConnectionRefusedError:
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(poll_seconds)
+
+def local_corpus(dispatcher, key, length, dtype, cache_dir):
+    # Downloaded once per machine into cache_dir (the worker processes of a
+    # machine share it), then memory-mapped
+    path = os.path.join(cache_dir, key)
+    if not os.path.exists(path):
+        size = length * np.dtype(dtype).itemsize
+        fd, tmp_path = tempfile.mkstemp(dir=cache_dir)
+        with os.fdopen(fd, 'wb') as f:
+            for offset in range(0, size, part_bytes):
+                f.write(dispatcher.corpus_part(key, offset))
+        os.replace(tmp_path, path)
+    return path, np.memmap(path, dtype=dtype, mode='r', shape=(length,))
+
+def remove_file(path):
+    if path is not None and os.path.exists(path):
+        os.remove(path)
+
+def run_worker(address, authkey, cache_dir=None, connect_timeout=60):
+    cache_dir = cache_dir or ('/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir())
+    dispatcher = connect(address, authkey, connect_timeout)
+    # Only the corpus of the current tasks is kept (the files come one by one)
+    key, path, ids = None, None, None
+    done = 0
+    try:
+        while True:
+            try:
+                task = dispatcher.get_task()
+            except (EOFError, ConnectionError):
+                break  # Coordinator gone
+            if task == 'stop':
+                break
+            if task is None:
+                time.sleep(poll_seconds)
+                continue
+            task_id, task_key, length, dtype, distances, seed = task
+            try:
+                if task_key != key:
+                    remove_file(path)
+                    key, path = None, None
+                    path, ids = local_corpus(dispatcher, task_key, length, dtype, cache_dir)
+                    key = task_key
+                values = null_rows(ids, [stream_seed(seed)], distances)[0]
+            except Exception as e:
+                dispatcher.put_error(task_id, repr(e))
+                continue
+            dispatcher.put_result(task_id, values)
+            done += 1
+    finally:
+        remove_file(path)
+    print(f"Worker {os.getpid()} finished after {done} tasks")
+
+def start_workers(address, authkey, processes, cache_dir=None):
+    workers = [Process(target=run_worker, args=(address, authkey, cache_dir)) for _ in range(processes)]
+    for worker in workers:
+        worker.start()
+    return workers
+
+if __name__ == "__main__":
+    # Worker node: MI_CLUSTER_AUTHKEY=<secret> python Work_queue.py host:port
+    # (the coordinator is the MI script run with a cluster address)
+    host, port = (sys.argv[1] if len(sys.argv) > 1 else "localhost:50000").rsplit(':', 1)
+    authkey = cluster_authkey()  # Same secret as the coordinator
+    processes = cpu_count()  # Worker processes on this machine
+    cache_dir = None  # Local copies of the corpora (/dev/shm by default)
+
+    for worker in start_workers((host, int(port)), authkey, processes, cache_dir):
+        worker.join()
@@ -1,5 +1,6 @@
 import pandas as pd
 import os
+import Run_log
 
 def csv_to_latex(input_csv, output_tex):
     # Read the CSV file into a pandas DataFrame
@@ -12,6 +13,9 @@ def csv_to_latex(input_csv, output_tex):
     with open(output_tex, 'w') as f:
         f.write(latex_table)
 
+def is_up_to_date(input_csv, output_tex):
+    return os.path.exists(output_tex) and os.path.getmtime(output_tex) >= os.path.getmtime(input_csv)
+
 def process_all_csv_files(input_directory, output_directory):
     # Ensure the output directory exists
     os.makedirs(output_directory, exist_ok=True)
@@ -23,13 +27,22 @@ def process_all_csv_files(input_directory, output_directory):
             input_csv_path = os.path.join(input_directory, filename)
             output_tex_filename = filename.replace('.csv', '.tex')
             output_tex_path = os.path.join(output_directory, output_tex_filename)
+            if is_up_to_date(input_csv_path, output_tex_path):
+                print(f"Up to date: {output_tex_filename}")
+                continue
             
             # Convert the CSV file to a LaTeX table
-            csv_to_latex(input_csv_path, output_tex_path)
+            with Run_log.stage('csv_to_latex', file=filename):
+                csv_to_latex(input_csv_path, output_tex_path)
+
+if __name__ == "__main__":
+    # Directories setup
+    input_directory = 'data/csv'
+    output_directory = 'data/tables'
+
+    run_log_path = os.path.join(output_directory, "run_log.json")  # None to disable
 
-# Directories setup
-input_directory = 'data/csv'
-output_directory = 'data/tables'
+    # Process all CSV files in the input directory
+    with Run_log.run_log(run_log_path, 'csv_to_latex'):
+        process_all_csv_files(input_directory, output_directory)
 
-# Process all CSV files in the input directory
-process_all_csv_files(input_directory, output_directory)
@@ -1,5 +1,7 @@
 import os
 import csv
+import Run_log
+from Token_store import load_corpus_stats
 
 def analyze_tokens_files(input_directory, output_directory):
     # Ensure the output directory exists
@@ -13,7 +15,7 @@ def analyze_tokens_files(input_directory, output_directory):
         # Initialize the CSV writer
         writer = csv.writer(csvfile)
         # Write the header row
-        writer.writerow(['File Name', 'Languaje', 'Length'])
+        writer.writerow(['File Name', 'Languaje', 'Length', 'Vocabulary', 'TTR'])
         
         # Walk through the input directory
         for root, dirs, files in os.walk(input_directory):
@@ -22,22 +24,24 @@ def analyze_tokens_files(input_directory, output_directory):
                 if file.endswith('.tokens'):
                     # Extract the base file name without .txt.tokens
                     base_name = file.replace('.txt.tokens', '')
-                    # Get the first two letters of the file name
-                    first_two_letters = base_name[:2]
-                    # Compute the length of the file in terms of tokens
+                    # Length, language and vocabulary come from the statistics manifest
                     file_path = os.path.join(root, file)
                     try:
-                        with open(file_path, 'r', encoding='utf-8') as f:
-                            tokens = f.read().split()
-                            length = len(tokens)
+                        stats = load_corpus_stats(file_path)
                         # Write to the CSV
-                        writer.writerow([base_name, first_two_letters, length])
+                        writer.writerow([base_name, stats['language'], stats['tokens'], stats['vocabulary'],
+                                         round(stats['type_token_ratio'], 4)])
                     except UnicodeDecodeError as e:
                         print(f"Error reading {file_path}: {e}")
 
-# Directories setup
-input_directory = 'data/tokenized'
-output_directory = 'data/csv'
+if __name__ == "__main__":
+    # Directories setup
+    input_directory = 'data/tokenized'
+    output_directory = 'data/csv'
+
+    run_log_path = os.path.join(output_directory, "run_log.json")  # None to disable
+
+    # Running the function with specified directories
+    with Run_log.run_log(run_log_path, 'lengths'), Run_log.stage('lengths'):
+        analyze_tokens_files(input_directory, output_directory)
 
-# Running the function with specified directories
-analyze_tokens_files(input_directory, output_directory)
@@ -2,35 +2,38 @@ import os
 import numpy as np
 import matplotlib.pyplot as plt
 from scipy.stats import theilslopes
+import Fit_engine
+import Run_log
+from Bootstrap import null_deviations
+from Results_store import list_corpora, load_results
+
+def threshold_points(mi_data, avg_shuffled_mi_data, percentage):
+    # Positions of the d > 0 values whose distance to the maximum of the
+    # shuffled MI is at least percentage of the distance from I(0)
+    distance_to_max = np.max(avg_shuffled_mi_data) - mi_data[0]
+    threshold_distance = distance_to_max * percentage
+    return np.abs(mi_data[1:] - np.max(avg_shuffled_mi_data)) >= threshold_distance
 
-def load_data(file_path):
-    return np.loadtxt(file_path)
-
-def plot_mi_d(mi_data, avg_shuffled_mi_data, output_path, percentage, log_scale=True):
-    d_values = np.arange(1, len(mi_data))
+def plot_mi_d(mi_data, avg_shuffled_mi_data, output_path, percentage, log_scale=True, distances=None):
+    # Distances of the result arrays (every d by default), without d = 0
+    d_values = np.arange(1, len(mi_data)) if distances is None else distances[1:]
     mi_values = mi_data[1:]  # Ignore the zero-distance value
     avg_shuffled_mi_values = avg_shuffled_mi_data[1:]  # Ignore the zero-distance value
 
     plt.figure(figsize=(7, 5))
     
-    # Calculate distance criteria
-    distance_to_max = np.max(avg_shuffled_mi_data) - mi_data[0]
-    threshold_distance = distance_to_max * percentage
-
-    # Calculate distances from max shuffled MI value
-    distances_from_max = np.abs(mi_values - np.max(avg_shuffled_mi_data))
-
     # Scatter plot for all points
     plt.scatter(d_values, mi_values, color='red', label=f'Distance < {percentage * 100}% of max')
 
     # Highlight points with distances >= threshold_distance
-    significant = distances_from_max >= threshold_distance
+    significant = threshold_points(mi_data, avg_shuffled_mi_data, percentage)
     plt.scatter(d_values[significant], mi_values[significant], color='blue', label=f'Distance >= {percentage * 100}% of max')
 
     # Plot the avg_shuffled_mi_data as an orange line
     plt.plot(d_values, avg_shuffled_mi_values, color='orange', label='Random MI', linestyle='-')
 
     # Perform Theil-Sen regression on log-transformed significant points
+    theil_sen_slope, theil_sen_intercept = np.nan, np.nan
     if np.any(significant):
         log_d_values = np.log(d_values[significant])
         log_mi_values = np.log(mi_values[significant])
@@ -64,42 +67,37 @@ def plot_mi_d(mi_data, avg_shuffled_mi_data, output_path, percentage, log_scale=
 
     return theil_sen_slope, theil_sen_intercept
 
-def save_theil_sen_data(mi_files, mi_results_dir, output_file, percentage):
-    with open(output_file, 'w') as f:
-        f.write("File,Slope,Intercept\n")
-        for mi_file in mi_files:
-            base_name = os.path.splitext(mi_file)[0]
-            mi_file_path = os.path.join(mi_results_dir, mi_file)
-            avg_shuffled_mi_file_path = os.path.join(mi_results_dir, f"{base_name}.avg_shuffled_mi")
-            
-            mi_data = load_data(mi_file_path)
-            avg_shuffled_mi_data = load_data(avg_shuffled_mi_file_path)
-            
-            output_plot_path = os.path.join("data/plots_2", f"{base_name}.png")
-            theil_sen_slope, theil_sen_intercept = plot_mi_d(mi_data, avg_shuffled_mi_data, output_plot_path, percentage=percentage)
-            f.write(f"{base_name},{theil_sen_slope},{theil_sen_intercept}\n")
-    print(f"Theil-Sen data saved to {output_file}")
+def save_theil_sen_data(corpora, mi_results_dir, output_file, percentage, resamples=2000, method='both'):
+    fits = []
+    for base_name in corpora:
+        results = load_results(mi_results_dir, base_name, fields=('mi', 'avg_shuffled_mi', 'shuffled_mis'))
+
+        mi_data = results['mi']
+        avg_shuffled_mi_data = results['avg_shuffled_mi']
+
+        output_plot_path = os.path.join("data/plots_2", f"{base_name}.png")
+        with Run_log.stage('plot', corpus=base_name, output=output_plot_path):
+            theil_sen_slope, theil_sen_intercept = plot_mi_d(mi_data, avg_shuffled_mi_data, output_plot_path, percentage=percentage, distances=results['distances'])
+        selected = threshold_points(mi_data, avg_shuffled_mi_data, percentage)
+        fits.append(([base_name, theil_sen_slope, theil_sen_intercept],
+                     [(results['distances'][1:][selected], mi_data[1:][selected],
+                       null_deviations(results, selected))]))
+
+    # Same 95% bootstrap interval of the slope as the Slope_2 column of Fit_engine
+    Fit_engine.write_fits(fits, output_file, resamples, method,
+                          columns=['File', 'Slope', 'Slope_low', 'Slope_high', 'Intercept'])
 
 if __name__ == "__main__":
     mi_results_dir = "data/mi_results"
     output_plot_dir = "data/plots_2"
     output_theil_sen_file = "data/csv/theil_sen_data_2.csv"
     os.makedirs(output_plot_dir, exist_ok=True)
+    run_log_path = os.path.join(output_plot_dir, "run_log.json")  # None to disable
 
     percentage = 0.01  # Set the percentage here
 
-    mi_files = [f for f in os.listdir(mi_results_dir) if f.endswith('.mi')]
-
-    for mi_file in mi_files:
-        base_name = os.path.splitext(mi_file)[0]
-        mi_file_path = os.path.join(mi_results_dir, mi_file)
-        avg_shuffled_mi_file_path = os.path.join(mi_results_dir, f"{base_name}.avg_shuffled_mi")
-        
-        mi_data = load_data(mi_file_path)
-        avg_shuffled_mi_data = load_data(avg_shuffled_mi_file_path)
-        
-        output_plot_path = os.path.join(output_plot_dir, f"{base_name}.png")
-        plot_mi_d(mi_data, avg_shuffled_mi_data, output_plot_path, percentage)
+    corpora = list_corpora(mi_results_dir)
 
-    save_theil_sen_data(mi_files, mi_results_dir, output_theil_sen_file, percentage)
-    print("All plots and Theil-Sen data generated.")
+    with Run_log.run_log(run_log_path, 'plot_2'):
+        save_theil_sen_data(corpora, mi_results_dir, output_theil_sen_file, percentage)
+        print("All plots and Theil-Sen data generated.")
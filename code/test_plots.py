@@ -2,15 +2,15 @@ import os
 import numpy as np
 import matplotlib.pyplot as plt
 from scipy.optimize import curve_fit
-
-def load_data(file_path):
-    return np.loadtxt(file_path)
+import Run_log
+from Results_store import list_corpora, load_results
 
 def power_law_with_constant(x, C, alpha, D):
     return C * x ** (-alpha) + D
 
-def plot_mi_d(mi_data, pvalues_data, avg_shuffled_mi_data, output_path, log_scale=True):
-    d_values = np.arange(1, len(mi_data))
+def plot_mi_d(mi_data, pvalues_data, avg_shuffled_mi_data, output_path, log_scale=True, distances=None):
+    # Distances of the result arrays (every d by default), without d = 0
+    d_values = np.arange(1, len(mi_data)) if distances is None else distances[1:]
     mi_values = mi_data[1:]  # Ignore the zero-distance value
     pvalues = pvalues_data[1:]  # Ignore the zero-distance value
     avg_shuffled_mi_values = avg_shuffled_mi_data[1:]  # Ignore the zero-distance value
@@ -22,13 +22,16 @@ def plot_mi_d(mi_data, pvalues_data, avg_shuffled_mi_data, output_path, log_scal
     plt.scatter(d_values[significant], mi_values[significant], color='blue', label='p-value < 0.05')
     plt.plot(d_values, avg_shuffled_mi_values, color='orange', label='Random MI', linestyle='-')
 
+    # C, alpha, D of the fit; None without significant points, NaN when it fails
+    params = None
     if np.any(significant):
         try:
             params, _ = curve_fit(power_law_with_constant, d_values[significant], mi_values[significant], p0=[1, 1, 1])
             regression_d_values = np.linspace(d_values[significant][0], d_values[significant][-1], 100)
             regression_line = power_law_with_constant(regression_d_values, *params)
             plt.plot(regression_d_values, regression_line, color='green', label=r'$I(d) \sim d^{-\alpha} + D$')
-        except RuntimeError:
+        except (RuntimeError, TypeError):  # TypeError: fewer points than parameters
+            params = np.full(3, np.nan)
             print(f"Optimal parameters not found for {output_path}")
 
     plt.xlabel('Distance (d)')
@@ -47,30 +50,25 @@ def plot_mi_d(mi_data, pvalues_data, avg_shuffled_mi_data, output_path, log_scal
     plt.close()
     print(f"Plot saved to {output_path}")
 
-def save_theil_sen_data(mi_files, mi_results_dir, output_file):
+    return params
+
+def save_theil_sen_data(corpora, mi_results_dir, output_file):
     with open(output_file, 'w') as f:
         f.write("File,C,Alpha,D\n")
-        for mi_file in mi_files:
-            base_name = os.path.splitext(mi_file)[0]
-            mi_file_path = os.path.join(mi_results_dir, mi_file)
-            pvalues_file_path = os.path.join(mi_results_dir, f"{base_name}.pvalues")
-            avg_shuffled_mi_file_path = os.path.join(mi_results_dir, f"{base_name}.avg_shuffled_mi")
+        for base_name in corpora:
+            results = load_results(mi_results_dir, base_name, fields=('mi', 'p_values', 'avg_shuffled_mi'))
             
-            mi_data = load_data(mi_file_path)
-            pvalues_data = load_data(pvalues_file_path)
-            avg_shuffled_mi_data = load_data(avg_shuffled_mi_file_path)
+            mi_data = results['mi']
+            pvalues_data = results['p_values']
+            avg_shuffled_mi_data = results['avg_shuffled_mi']
             
             output_plot_path = os.path.join("data/test_plots", f"{base_name}.png")
-            plot_mi_d(mi_data, pvalues_data, avg_shuffled_mi_data, output_plot_path)
+            with Run_log.stage('plot', corpus=base_name, output=output_plot_path):
+                params = plot_mi_d(mi_data, pvalues_data, avg_shuffled_mi_data, output_plot_path, distances=results['distances'])
 
-            if np.any(pvalues_data[1:] < 0.05):
-                d_values = np.arange(1, len(mi_data))
-                significant = pvalues_data[1:] < 0.05
-                try:
-                    params, _ = curve_fit(power_law_with_constant, d_values[significant], mi_data[1:][significant], p0=[1, 1, 1])
-                    f.write(f"{base_name},{params[0]},{params[1]},{params[2]}\n")
-                except RuntimeError:
-                    f.write(f"{base_name},NaN,NaN,NaN\n")
+            # The fit of the plot is reused; corpora without significant points have no row
+            if params is not None:
+                f.write(f"{base_name},{params[0]},{params[1]},{params[2]}\n")
     print(f"Theil-Sen data saved to {output_file}")
 
 if __name__ == "__main__":
@@ -78,21 +76,10 @@ if __name__ == "__main__":
     output_plot_dir = "data/test_plots"
     output_theil_sen_file = "data/csv/power_ct.csv"
     os.makedirs(output_plot_dir, exist_ok=True)
+    run_log_path = os.path.join(output_plot_dir, "run_log.json")  # None to disable
 
-    mi_files = [f for f in os.listdir(mi_results_dir) if f.endswith('.mi')]
-
-    for mi_file in mi_files:
-        base_name = os.path.splitext(mi_file)[0]
-        mi_file_path = os.path.join(mi_results_dir, mi_file)
-        pvalues_file_path = os.path.join(mi_results_dir, f"{base_name}.pvalues")
-        avg_shuffled_mi_file_path = os.path.join(mi_results_dir, f"{base_name}.avg_shuffled_mi")
-        
-        mi_data = load_data(mi_file_path)
-        pvalues_data = load_data(pvalues_file_path)
-        avg_shuffled_mi_data = load_data(avg_shuffled_mi_file_path)
-        
-        output_plot_path = os.path.join(output_plot_dir, f"{base_name}.png")
-        plot_mi_d(mi_data, pvalues_data, avg_shuffled_mi_data, output_plot_path)
+    corpora = list_corpora(mi_results_dir)
 
-    save_theil_sen_data(mi_files, mi_results_dir, output_theil_sen_file)
-    print("All plots and fitting data generated.")
+    with Run_log.run_log(run_log_path, 'test_plots'):
+        save_theil_sen_data(corpora, mi_results_dir, output_theil_sen_file)
+        print("All plots and fitting data generated.")
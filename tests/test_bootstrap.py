@@ -0,0 +1,18 @@
+import numpy as np
+from Bootstrap import bootstrap_slopes
+
+def point_set(rng, n, shuffles, slope):
+    d = np.arange(1, n + 1)
+    mi = 0.5 * d ** slope * np.exp(rng.normal(0, 0.05, n))
+    return d, mi, rng.normal(0, 0.01, (shuffles, n))
+
+def test_interval_does_not_depend_on_other_corpora():
+    rng = np.random.default_rng(0)
+    quixote, macbeth = point_set(rng, 20, 30, -0.52), point_set(rng, 28, 50, -0.3)
+    alone = bootstrap_slopes([quixote], 500, keys=['quixote'])
+    together = bootstrap_slopes([quixote, macbeth], 500, keys=['quixote', 'macbeth'])
+    swapped = bootstrap_slopes([macbeth, quixote], 500, keys=['macbeth', 'quixote'])
+    assert np.array_equal(alone[0], together[0])
+    assert np.array_equal(alone[0], swapped[1])
+    assert np.array_equal(together[1], swapped[0])
+    assert alone[0, 0] < -0.52 < alone[0, 1]
@@ -0,0 +1,41 @@
+import json
+import os
+import numpy as np
+from Fit_engine import write_fits
+from Report import write_report
+
+corpora = {'en_book1': ('en', -0.5), 'ja_book1': ('ja', -0.3), 'zh_book1': ('zh', -0.4)}
+
+def add_corpus(tokenized_dir, name):
+    language, _ = corpora[name]
+    open(os.path.join(tokenized_dir, f"{name}.txt.tokens"), 'w').close()
+    with open(os.path.join(tokenized_dir, f"{name}.txt.stats.json"), 'w') as f:
+        json.dump({'language': language, 'tokens': 1000, 'vocabulary': 300, 'type_token_ratio': 0.3}, f)
+
+def fit(name):
+    # A fit_corpus row and its two point sets, from a fixed synthetic I(d)
+    _, slope = corpora[name]
+    rng = np.random.default_rng(len(name) + sum(map(ord, name)))
+    d = np.arange(1, 21)
+    mi = 0.5 * d ** slope * np.exp(rng.normal(0, 0.05, len(d)))
+    points = (d, mi, rng.normal(0, 0.01, (10, len(d))))
+    return [f"{name}.txt.tokens", slope, 0.0, slope, 0.0, 1.0, -slope, 0.0], [points, points]
+
+def test_new_corpus_only_renders_its_language_and_the_summary(tmp_path, capsys):
+    tokenized_dir, tables_dir = tmp_path / 'tokenized', tmp_path / 'tables'
+    tokenized_dir.mkdir()
+    fits_file = str(tmp_path / 'fits.csv')
+    for name in ('en_book1', 'ja_book1'):
+        add_corpus(tokenized_dir, name)
+    write_fits([fit(name) for name in ('en_book1', 'ja_book1')], fits_file, resamples=200)
+    write_report(tokenized_dir, fits_file, tables_dir)
+    before = {name: (tables_dir / f"{name}.tex").read_text() for name in ('corpora_en', 'corpora_ja')}
+
+    add_corpus(tokenized_dir, 'zh_book1')
+    write_fits([fit(name) for name in ('en_book1', 'ja_book1', 'zh_book1')], fits_file, resamples=200)
+    capsys.readouterr()
+    write_report(tokenized_dir, fits_file, tables_dir)
+    assert "Report: 2 of 4 tables rendered" in capsys.readouterr().out
+    for name, text in before.items():
+        assert (tables_dir / f"{name}.tex").read_text() == text
+    assert (tables_dir / 'corpora_zh.tex').exists()